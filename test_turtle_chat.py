@@ -0,0 +1,750 @@
+# test_turtle_chat.py
+# Behaviour tests.  The UI runs on the headless renderer, so no display is
+# needed; the server's queues and search index are used directly.
+#
+#   python -m unittest test_turtle_chat
+
+import io
+import sys
+import time
+import socket
+import subprocess
+import tempfile
+import os
+import struct
+import threading
+import unittest
+from contextlib import redirect_stdout
+from turtle_chat_render import HeadlessRenderer
+from turtle_chat_bench import make_view
+from turtle_chat_view import View
+from turtle_chat_widgets import TextLayout, TextInput
+from turtle_chat_view import TextBox
+from turtle_chat_search import SearchIndex
+from turtle_chat_capture import CaptureWriter, read_capture, CONNECT, DATA, CLOSE
+from turtle_chat_replay import Replay
+from turtle_chat_client import Client, MuxClient
+from turtle_chat_server import OutboundQueue, CONTROL, INTERACTIVE, BULK
+
+def connect(client_class=Client):
+    '''
+    :return: (client, socket) - a new client_class connected to a plain
+             listening socket, and the server's end of the connection.
+    '''
+    listener=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    listener.bind(('localhost',0))
+    listener.listen(1)
+    with redirect_stdout(io.StringIO()):
+        client=client_class(port=listener.getsockname()[1])
+    peer,addr=listener.accept()
+    listener.close()
+    return client,peer
+
+class ServerProcess:
+    '''
+    A chat server running in a child process, on free ports.
+    '''
+    _SCRIPT=('import sys, signal, turtle_chat_server as server\n'
+             'signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())\n'
+             'for setting in sys.argv[2:]:\n'
+             '    name, value = setting.split("=")\n'
+             '    setattr(server, name, int(value))\n'
+             'server.chat_server(PORT=int(sys.argv[1]))\n')
+
+    def __init__(self,**settings):
+        '''
+        :param settings: integer values for turtle_chat_server's globals,
+                         e.g. MAX_ATTACHMENT=1000.
+        '''
+        self.port=ServerProcess.free_port()
+        self.process=subprocess.Popen([sys.executable,'-c',ServerProcess._SCRIPT,str(self.port)]+
+                                      ['%s=%d' % item for item in settings.items()],
+                                      stdout=subprocess.DEVNULL)
+        deadline=time.time()+10
+        while True:
+            try:
+                socket.create_connection(('localhost',self.port+1)).close()
+                return
+            except ConnectionRefusedError:
+                if time.time()>deadline:
+                    raise
+                time.sleep(0.02)
+
+    @staticmethod
+    def free_port():
+        '''
+        :return: a port number free, along with the one after it.
+        '''
+        while True:
+            with socket.socket() as first:
+                first.bind(('localhost',0))
+                port=first.getsockname()[1]
+                with socket.socket() as second:
+                    try:
+                        second.bind(('localhost',port+1))
+                        return port
+                    except OSError:
+                        pass
+
+    def client(self,client_class=Client):
+        with redirect_stdout(io.StringIO()):
+            return client_class(port=self.port)
+
+    def running(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+def receive_until(client,text,timeout=5):
+    '''
+    :return: everything client received, up to and including text.
+    '''
+    received=''
+    deadline=time.time()+timeout
+    while text not in received and time.time()<deadline:
+        msg=client.receive()
+        if msg==Client._END_MSG:
+            break
+        if msg is not None:
+            received+=msg
+    return received
+
+def read_all(sock,n):
+    '''
+    :return: bytes, n of them read from a blocking socket.
+    '''
+    data=bytearray()
+    while len(data)<n:
+        chunk=sock.recv(min(65536,n-len(data)))
+        if len(chunk)==0:
+            break
+        data+=chunk
+    return bytes(data)
+
+class TestHeadlessRenderer(unittest.TestCase):
+    def test_keys_without_a_handler_go_to_keypress(self):
+        renderer=HeadlessRenderer()
+        pressed=[]
+        renderer.onkeypress(lambda: pressed.append('Return'),'Return')
+        renderer.bind('<KeyPress>',lambda event: pressed.append(event.keysym))
+        renderer.press('a')
+        renderer.press('Return')
+        self.assertEqual(pressed,['a','Return'])
+
+    def test_run_pending_runs_callbacks_they_queue(self):
+        renderer=HeadlessRenderer()
+        ran=[]
+        renderer.after_idle(lambda: renderer.ontimer(lambda: ran.append(2)) or ran.append(1))
+        renderer.run_pending()
+        self.assertEqual(ran,[1,2])
+        self.assertEqual(renderer.pending,[])
+
+    def test_view_draws_in_one_frame(self):
+        view,renderer=make_view()
+        self.assertEqual([name for pen,name,args in renderer.ops].count('update'),1)
+
+class TestClientSend(unittest.TestCase):
+    def test_send_writes_at_once(self):
+        client,peer=connect()
+        client.send('hello')
+        self.assertFalse(client.has_pending())
+        peer.settimeout(1)
+        self.assertEqual(peer.recv(100),b'hello')
+        client.close()
+        peer.close()
+
+    def test_partial_writes_stay_queued(self):
+        client,peer=connect()
+        client.get_server().setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,65536)
+        peer.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,65536)
+        data=bytes(range(256))*8192 #2 MB, more than the socket buffers hold
+        client.send_bytes(data)
+        self.assertTrue(client.has_pending())
+        #Writing what fits returns without waiting for the reader.
+        remaining=client.flush(block=False)
+        self.assertGreater(remaining,0)
+        client.send('tail')
+        received=[]
+        reader=threading.Thread(target=lambda: received.append(read_all(peer,len(data)+4)))
+        reader.start()
+        self.assertEqual(client.flush(),0)
+        reader.join()
+        self.assertEqual(received[0],data+b'tail')
+        client.close()
+        peer.close()
+
+    def test_close_delivers_what_is_queued(self):
+        client,peer=connect()
+        data=b'x'*(4*1024*1024)
+        client.send_bytes(data)
+        received=[]
+        reader=threading.Thread(target=lambda: received.append(read_all(peer,len(data)+1)))
+        reader.start()
+        client.close()
+        reader.join()
+        self.assertEqual(received[0],data)
+        peer.close()
+
+    def test_send_many_is_one_write(self):
+        client,peer=connect()
+        client.send_many(['hi\n','there\n'])
+        peer.settimeout(1)
+        self.assertEqual(read_all(peer,9),b'hi\nthere\n')
+        client.close()
+        peer.close()
+
+class TestMuxClient(unittest.TestCase):
+    def setUp(self):
+        self.mux,self.peer=connect(MuxClient)
+        self.sessions=[self.mux.open_session('user%d' % i) for i in range(3)]
+        self.peer.settimeout(1)
+        self.buffer=bytearray()
+
+    def tearDown(self):
+        self.mux.server.close()
+        self.peer.close()
+
+    def frames_sent(self,n):
+        '''
+        :return: list of the next n frames the client wrote.
+        '''
+        frames=[]
+        while len(frames)<n:
+            self.buffer+=self.peer.recv(65536)
+            frames+=MuxClient.unpack_frames(self.buffer)
+        return frames
+
+    def test_sessions_are_opened(self):
+        self.assertEqual(read_all(self.peer,len(MuxClient._HELLO)),MuxClient._HELLO)
+        self.assertEqual(self.frames_sent(3),[(i,MuxClient._OPEN,b'user%d' % i) for i in range(3)])
+
+    def test_send_many_frames_every_message(self):
+        read_all(self.peer,len(MuxClient._HELLO))
+        self.frames_sent(3)
+        self.mux.send_many(['a','bc'],2)
+        self.mux.send_bytes(b'z')
+        self.assertEqual(self.frames_sent(5),[(2,MuxClient._DATA,b'a'),(2,MuxClient._DATA,b'bc'),
+                                 (0,MuxClient._DATA,b'z'),(1,MuxClient._DATA,b'z'),(2,MuxClient._DATA,b'z')])
+
+    def test_partial_frame_is_kept(self):
+        buffer=bytearray(MuxClient.pack_frame(1,MuxClient._DATA,b'hello'))
+        tail=buffer[-2:]
+        del buffer[-2:]
+        self.assertEqual(MuxClient.unpack_frames(buffer),[])
+        buffer+=tail
+        self.assertEqual(MuxClient.unpack_frames(buffer),[(1,MuxClient._DATA,b'hello')])
+
+    def test_poll_hands_out_messages(self):
+        first,second,third=self.sessions
+        first.inbox.append('unread')
+        self.peer.sendall(MuxClient.pack_frame(0,MuxClient._DATA,b'one')+
+                          MuxClient.pack_frame(1,MuxClient._BROADCAST,b'all')+
+                          MuxClient.pack_frame(1,MuxClient._BROADCAST,b'\xffbad'))
+        updated=self.mux.poll(1)
+        #A session with unread messages is still reported.
+        self.assertEqual(set(updated),{first,third})
+        self.assertEqual(list(first.inbox),['unread','one','all','\ufffdbad'])
+        self.assertEqual(list(second.inbox),[])
+        self.assertEqual(list(third.inbox),['all','\ufffdbad'])
+
+    def test_broadcast_to_every_session(self):
+        self.peer.sendall(MuxClient.pack_frame(MuxClient._NO_SESSION,MuxClient._BROADCAST,b'hi'))
+        self.assertEqual(set(self.mux.poll(1)),set(self.sessions))
+        self.assertEqual([session.receive() for session in self.sessions],['hi']*3)
+
+    def test_reset_closes(self):
+        #Closing with unread data makes the peer send a reset.
+        self.peer.setsockopt(socket.SOL_SOCKET,socket.SO_LINGER,struct.pack('ii',1,0))
+        self.peer.close()
+        self.assertEqual(self.mux.receive_all(),Client._END_MSG)
+        self.assertEqual(self.sessions[0].receive(),Client._END_MSG)
+
+class TestMuxServer(unittest.TestCase):
+    def setUp(self):
+        self.server=ServerProcess()
+        self.watcher=self.server.client()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.server.stop()
+
+    def test_many_sessions_on_one_connection(self):
+        mux=self.server.client(MuxClient)
+        sessions=[mux.open_session('user%d' % i) for i in range(2000)]
+        mux.flush()
+        deadline=time.time()+30
+        while len(sessions[-1].inbox)<1999 and not mux.closed and time.time()<deadline:
+            mux.poll(0.1)
+        self.assertFalse(mux.closed)
+        self.assertEqual(len(sessions[0].inbox),1999)
+        self.assertEqual(len(sessions[-1].inbox),1999)
+        sessions[5].send('hello\n')
+        self.assertIn('hello\n',receive_until(self.watcher,'hello\n'))
+        mux.close()
+
+    def test_hello_split_over_reads(self):
+        raw=socket.create_connection(('localhost',self.server.port))
+        hello=MuxClient._HELLO
+        raw.sendall(hello[:3])
+        time.sleep(0.1)
+        raw.sendall(hello[3:]+MuxClient.pack_frame(0,MuxClient._OPEN,b'split'))
+        time.sleep(0.1)
+        raw.sendall(MuxClient.pack_frame(0,MuxClient._DATA,b'framed\n'))
+        received=receive_until(self.watcher,'framed\n')
+        self.assertIn('split entered our chat session\n',received)
+        self.assertIn('framed\n',received)
+        raw.close()
+
+    def test_bad_text_does_not_stop_the_server(self):
+        raw=socket.create_connection(('localhost',self.server.port))
+        raw.sendall(MuxClient._HELLO+MuxClient.pack_frame(0,MuxClient._OPEN,b'\xff')+
+                    MuxClient.pack_frame(0,MuxClient._DATA,b'\xfe bad\n'))
+        self.assertIn('\ufffd bad\n',receive_until(self.watcher,'bad\n'))
+        self.assertTrue(self.server.running())
+        raw.close()
+
+class SlowSocket:
+    '''
+    Socket stand-in taking at most n bytes per send.
+    '''
+    def __init__(self,n):
+        self.n=n
+        self.data=bytearray()
+
+    def send(self,data):
+        sent=min(len(data),self.n)
+        self.data+=data[:sent]
+        return sent
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_control_goes_ahead_of_queued_bulk(self):
+        queue=OutboundQueue()
+        sock=SlowSocket(1000)
+        for i in range(3):
+            queue.put(b'B'*5000,BULK)
+        queue.write(sock)
+        queue.put(b'CONTROL',CONTROL)
+        while queue.pending():
+            queue.write(sock)
+        #Only the message already being written goes first.
+        self.assertEqual(sock.data.find(b'CONTROL'),5000)
+        self.assertEqual(len(sock.data),15007)
+
+    def test_weights(self):
+        queue=OutboundQueue()
+        sock=SlowSocket(3000)
+        for i in range(3000):
+            for priority in (CONTROL,INTERACTIVE,BULK):
+                queue.put(bytes([priority])*100,priority)
+        for i in range(50):
+            queue.write(sock)
+        counts=[sock.data.count(bytes([priority])) for priority in (CONTROL,INTERACTIVE,BULK)]
+        self.assertGreater(counts[0],counts[1])
+        self.assertGreater(counts[1],counts[2])
+        self.assertGreater(counts[2],0)
+
+    def test_messages_are_not_interleaved(self):
+        queue=OutboundQueue()
+        sock=SlowSocket(7)
+        messages=[(b'a'*30,BULK),(b'b'*20,INTERACTIVE),(b'c'*10,CONTROL),(b'd'*40,BULK)]
+        for data,priority in messages:
+            queue.put(data,priority)
+        while queue.pending():
+            queue.write(sock)
+        #Each message arrives as one unbroken run of its letter.
+        runs=[]
+        for byte in bytes(sock.data):
+            if not runs or runs[-1][0]!=byte:
+                runs.append([byte,0])
+            runs[-1][1]+=1
+        self.assertEqual(sorted((chr(byte),n) for byte,n in runs),[('a',30),('b',20),('c',10),('d',40)])
+
+class TestScrollback(unittest.TestCase):
+    def setUp(self):
+        self.view,self.renderer=make_view()
+        self.scrollback=self.view.scrollback
+        for i in range(30):
+            self.scrollback.add('line %d' % i)
+
+    def test_follows_new_messages(self):
+        self.renderer.run_pending()
+        self.assertEqual(self.scrollback.visible_lines()[0],'line 29')
+        self.assertEqual(self.scrollback.shown[0],'line 29')
+
+    def test_scrolled_back_rows_stay_put(self):
+        self.renderer.press('Up')
+        self.renderer.press('Up')
+        self.assertEqual(self.scrollback.offset,2)
+        shown=self.scrollback.visible_lines()
+        self.scrollback.add('new')
+        self.assertEqual(self.scrollback.offset,3)
+        self.assertEqual(self.scrollback.visible_lines(),shown)
+
+    def test_scroll_is_clamped(self):
+        self.renderer.press('Down')
+        self.assertEqual(self.scrollback.offset,0)
+        for i in range(10):
+            self.renderer.press('Prior')
+        self.assertEqual(self.scrollback.offset,30-self.scrollback.rows)
+        self.assertEqual(self.scrollback.visible_lines()[-1],'line 0')
+
+    def test_rows_are_between_textbox_and_window_top(self):
+        box=self.view.textbox
+        rows=[args for pen,name,args in self.renderer.ops
+              if name=='goto' and pen in [p.pen_id for p in self.scrollback.pens]]
+        self.assertEqual(len(rows),self.scrollback.rows)
+        for x,y in rows:
+            self.assertGreater(y,box.pos[1]+box.height/2)
+            #Leave room for the text, which is drawn above its position.
+            self.assertLess(y,View._SCREEN_HEIGHT/2-View._ROW_HEIGHT/2)
+
+class TestKeys(unittest.TestCase):
+    def setUp(self):
+        self.view,self.renderer=make_view()
+
+    def test_keymap_keys_type_their_character(self):
+        for key in ['H','i','space','exclam','numbersign','7']:
+            self.renderer.press(key)
+        self.renderer.run_pending()
+        self.assertEqual(self.view.textbox.get_msg(),'Hi !#7')
+
+    def test_unmapped_keys_are_ignored(self):
+        for key in ['a','Shift_L','F1','b']:
+            self.renderer.press(key)
+        self.assertEqual(self.view.textbox.get_msg(),'ab')
+
+    def test_backspace_and_return(self):
+        for key in ['a','b','c','BackSpace','d']:
+            self.renderer.press(key)
+        self.renderer.press('Return')
+        self.assertEqual(self.view.my_client.sent,['abd'])
+        self.assertEqual(self.view.textbox.get_msg(),'')
+
+    def test_keystrokes_in_one_frame_are_drawn_once(self):
+        textbox=self.view.textbox
+        redraws=[]
+        textbox.write_msg=lambda: redraws.append(textbox.get_msg())
+        for key in ['a','b','c']:
+            self.renderer.press(key)
+        self.renderer.run_pending()
+        self.assertEqual(redraws,['abc'])
+
+class TestTextLayout(unittest.TestCase):
+    def test_append_marks_only_changed_lines(self):
+        layout=TextLayout(4)
+        layout.append('abcdef')
+        self.assertEqual(layout.lines,['abcd','ef'])
+        self.assertEqual(layout.take_dirty(),[0,1])
+        layout.append('gh')
+        self.assertEqual(layout.lines,['abcd','efgh'])
+        self.assertEqual(layout.take_dirty(),[1])
+        layout.append('i')
+        self.assertEqual(layout.take_dirty(),[2])
+
+    def test_backspace_marks_removed_lines(self):
+        layout=TextLayout(4)
+        layout.append('abcdef')
+        layout.take_dirty()
+        layout.backspace(3)
+        self.assertEqual(layout.lines,['abc'])
+        self.assertEqual(layout.take_dirty(),[0,1])
+
+    def test_reset_marks_old_and_new_lines(self):
+        layout=TextLayout(4)
+        layout.append('abcdefghi')
+        layout.take_dirty()
+        layout.reset('xy')
+        self.assertEqual(layout.lines,['xy'])
+        self.assertEqual(layout.take_dirty(),[0,1,2])
+
+    def test_only_changed_lines_are_redrawn(self):
+        view,renderer=make_view()
+        textbox=view.textbox
+        textbox.insert_text('x'*50)
+        renderer.run_pending()
+        renderer.ops=[]
+        renderer.press('y')
+        renderer.run_pending()
+        self.assertEqual([(pen,name) for pen,name,args in renderer.ops],
+                         [(textbox.line_pens[1].pen_id,'clear'),(textbox.line_pens[1].pen_id,'write')])
+
+    def test_new_line_pens_move_without_animation(self):
+        view,renderer=make_view()
+        view.textbox.insert_text('x'*100)
+        renderer.run_pending()
+        for pen in view.textbox.line_pens:
+            calls=[name for pen_id,name,args in renderer.ops if pen_id==pen.pen_id]
+            self.assertLess(calls.index('speed'),calls.index('goto'))
+
+class TestPaste(unittest.TestCase):
+    def test_paste_is_cut_to_what_the_box_shows(self):
+        view,renderer=make_view()
+        box=view.textbox
+        renderer.clipboard_text='x'*1000
+        renderer.events['<Control-v>']()
+        renderer.run_pending()
+        self.assertEqual(len(box.get_msg()),box.capacity())
+        self.assertEqual(len(box.layout.lines),box.height//TextInput._LINE_HEIGHT)
+        #Every line is drawn inside the box.
+        line_pens=[pen.pen_id for pen in box.line_pens]
+        for pen,name,args in renderer.ops:
+            if name=='goto' and pen in line_pens:
+                self.assertGreater(args[1],box.pos[1]-box.height/2)
+
+    def test_typing_stops_when_the_box_is_full(self):
+        view,renderer=make_view()
+        box=view.textbox
+        box.insert_text('x'*box.capacity())
+        renderer.press('y')
+        self.assertEqual(box.get_msg(),'x'*box.capacity())
+
+    def test_insert_text_replaces_line_breaks(self):
+        box=TextBox(renderer=HeadlessRenderer(),max_msg_length=5)
+        self.assertEqual(box.insert_text('a\r\nb\tc'),5)
+        self.assertEqual(box.get_msg(),'a b c')
+        self.assertEqual(box.insert_text('more'),0)
+
+class TestSearch(unittest.TestCase):
+    def test_ranking(self):
+        index=SearchIndex()
+        index.add('apple')
+        index.add('apple banana')
+        index.add('apple apple')
+        index.add('cherry')
+        total,results=index.search('apple banana')
+        self.assertEqual(total,3)
+        #Both words first, then more occurrences, then newest.
+        self.assertEqual([msg_id for msg_id,text in results],[1,2,0])
+
+    def test_pages(self):
+        index=SearchIndex()
+        for i in range(25):
+            index.add('word %d' % i)
+        total,page=index.search('word',page=3,page_size=10)
+        self.assertEqual(total,25)
+        self.assertEqual([msg_id for msg_id,text in page],[4,3,2,1,0])
+        self.assertEqual(index.search('word',page=4,page_size=10)[1],[])
+
+    def test_eviction(self):
+        index=SearchIndex(segment_size=2,max_segments=2)
+        for i in range(5):
+            index.add('word %d' % i)
+        self.assertIsNone(index.get(0))
+        self.assertIsNone(index.get(1))
+        self.assertEqual(index.get(2),'word 2')
+        total,results=index.search('word')
+        self.assertEqual(total,3)
+        self.assertEqual([msg_id for msg_id,text in results],[4,3,2])
+
+class TestSearchCommand(unittest.TestCase):
+    def setUp(self):
+        self.server=ServerProcess()
+        self.searcher=self.server.client()
+        self.watcher=self.server.client()
+        receive_until(self.searcher,'entered our chat session\n')
+
+    def tearDown(self):
+        self.searcher.close()
+        self.watcher.close()
+        self.server.stop()
+
+    def search(self,command,until='\n'):
+        self.searcher.send(command)
+        return receive_until(self.searcher,until)
+
+    def test_results_go_to_the_searcher_only(self):
+        self.searcher.send('hello world\n')
+        receive_until(self.watcher,'hello world')
+        reply=self.search('/search world','[#0] hello world\n')
+        self.assertEqual(reply,"Search 'world': 1 results, page 1 of 1\n[#0] hello world\n")
+        self.assertNotIn('/search',receive_until(self.watcher,'/search',0.3))
+
+    def test_bad_commands_get_usage(self):
+        for command in ['/search','/search #2','/search foo #0']:
+            self.assertIn('Usage: /search',self.search(command))
+        self.assertNotIn('/search',receive_until(self.watcher,'/search',0.3))
+
+class TestAttachments(unittest.TestCase):
+    def setUp(self):
+        before=set(os.listdir(tempfile.gettempdir()))
+        self.server=ServerProcess(MAX_ATTACHMENT=100000,MAX_ATTACHMENTS=2)
+        self.spool=[name for name in os.listdir(tempfile.gettempdir())
+                    if name.startswith('turtle_chat_') and name not in before]
+        self.sharer=self.server.client()
+        self.watcher=self.server.client()
+        receive_until(self.sharer,'entered our chat session\n')
+        self.files=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.sharer.close()
+        self.watcher.close()
+        self.server.stop()
+        self.files.cleanup()
+
+    def write_file(self,name,data):
+        path=os.path.join(self.files.name,name)
+        with open(path,'wb') as f:
+            f.write(data)
+        return path
+
+    def test_upload_and_download(self):
+        data=os.urandom(50000)
+        file_id=self.sharer.upload(self.write_file('notes.bin',data))
+        self.assertIn("File #%d 'notes.bin' (50000 bytes) shared\n" % file_id,
+                      receive_until(self.watcher,'shared\n'))
+        path=os.path.join(self.files.name,'copy')
+        self.assertEqual(self.watcher.download(file_id,path),'notes.bin')
+        with open(path,'rb') as f:
+            self.assertEqual(f.read(),data)
+
+    def test_too_large_upload_gets_the_error(self):
+        path=self.write_file('big.bin',bytes(5*1024*1024))
+        with self.assertRaisesRegex(ConnectionError,'file too large'):
+            self.sharer.upload(path)
+        self.assertTrue(self.server.running())
+
+    def test_bad_download_gets_the_error(self):
+        with self.assertRaisesRegex(ConnectionError,'bad request'):
+            self.watcher.download(7,os.path.join(self.files.name,'copy'))
+
+    def test_oldest_file_is_dropped(self):
+        ids=[self.sharer.upload(self.write_file('f%d' % i,b'%d' % i)) for i in range(3)]
+        with self.assertRaisesRegex(ConnectionError,'bad request'):
+            self.watcher.download(ids[0],os.path.join(self.files.name,'copy'))
+        self.assertEqual(self.watcher.download(ids[2],os.path.join(self.files.name,'copy')),'f2')
+
+    def test_spool_is_removed_on_exit(self):
+        self.sharer.upload(self.write_file('kept.bin',b'data'))
+        self.assertEqual(len(self.spool),1)
+        spool=os.path.join(tempfile.gettempdir(),self.spool[0])
+        self.assertEqual(len(os.listdir(spool)),1)
+        self.server.stop()
+        self.assertFalse(os.path.exists(spool))
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        handle,self.path=tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        first,second,unknown=object(),object(),object()
+        writer=CaptureWriter(self.path)
+        writer.record(first,CONNECT)
+        writer.record(second,CONNECT)
+        writer.record(first,DATA,b'hello')
+        writer.record(unknown,DATA,b'not recorded')
+        writer.record(second,DATA,b'')
+        writer.record(first,CLOSE)
+        writer.record(first,DATA,b'after close')
+        #Records are on disk before the writer is closed.
+        records=[(conn_id,kind,data) for timestamp,conn_id,kind,data in read_capture(self.path)]
+        writer.close()
+        self.assertEqual(records,[(0,CONNECT,b''),(1,CONNECT,b''),(0,DATA,b'hello'),
+                                  (1,DATA,b''),(0,CLOSE,b'')])
+        times=[timestamp for timestamp,conn_id,kind,data in read_capture(self.path)]
+        self.assertEqual(times,sorted(times))
+
+    def test_cut_short_record_is_ignored(self):
+        sock=object()
+        writer=CaptureWriter(self.path)
+        writer.record(sock,CONNECT)
+        writer.record(sock,DATA,b'complete')
+        writer.record(sock,DATA,b'cut short')
+        writer.close()
+        with open(self.path,'r+b') as f:
+            f.truncate(os.path.getsize(self.path)-3)
+        self.assertEqual([data for timestamp,conn_id,kind,data in read_capture(self.path)],[b'',b'complete'])
+
+class TestReplayMatch(unittest.TestCase):
+    def replay(self,sent,received):
+        replay=Replay('unused.cap')
+        for message in sent:
+            replay.expect(message,0.0)
+        replay.received+=received
+        replay.match(1.0)
+        return replay
+
+    def test_notices_are_skipped(self):
+        replay=self.replay([b'hi',b'there'],
+                           b'[127.0.0.1:5000] entered our chat session\nhiClient (127.0.0.1, 5000) is offline\nthere')
+        self.assertEqual(replay.waiting(),0)
+        self.assertEqual(replay.unexpected,0)
+
+    def test_unexpected_data_does_not_hide_messages(self):
+        replay=self.replay([b'from a',b'from b'],b'from ajunkfrom b')
+        self.assertEqual(replay.waiting(),0)
+        self.assertEqual(replay.unexpected,4)
+
+    def noted(self,records,received):
+        replay=Replay('unused.cap')
+        for conn_id,data in records:
+            replay.note(conn_id,data,0.0)
+        replay.received+=received
+        replay.match(1.0)
+        return replay
+
+    def test_relayed_search_is_matched(self):
+        #Read together with the message before it, a search is relayed as chat.
+        replay=self.noted([(0,b'hi'),(0,b'/search x'),(1,b'from b')],b'hi/search xfrom b')
+        self.assertEqual(replay.waiting(),0)
+        self.assertEqual(len(replay.latencies),3)
+
+    def test_answered_search_is_not_missed(self):
+        replay=self.noted([(0,b'hi'),(0,b'/search x'),(1,b'from b')],b'hifrom b')
+        self.assertEqual(replay.waiting(),0)
+
+    def test_message_joined_to_a_search_is_not_missed(self):
+        replay=self.noted([(0,b'/search x'),(0,b'from a'),(1,b'from b')],b'from b')
+        self.assertEqual(replay.waiting(),0)
+        #Records far apart in time are not joined.
+        replay=Replay('unused.cap')
+        replay.note(0,b'/search x',0.0)
+        replay.note(0,b'from a',1.0)
+        self.assertEqual(replay.waiting(),1)
+
+    def test_search_frames_are_never_relayed(self):
+        hello=MuxClient._HELLO+MuxClient.pack_frame(0,MuxClient._OPEN,b'bot')
+        replay=self.noted([(0,hello),(0,MuxClient.pack_frame(0,MuxClient._DATA,b'/search x'))],
+                          b'bot entered our chat session\n')
+        self.assertEqual(replay.expected,{})
+
+    def test_waits_for_the_rest_of_a_message(self):
+        replay=self.replay([b'hello'],b'hel')
+        self.assertEqual(replay.waiting(),1)
+        self.assertEqual(replay.unexpected,0)
+        replay.received+=b'lo'
+        replay.match(1.0)
+        self.assertEqual(replay.waiting(),0)
+
+class TestReplay(unittest.TestCase):
+    def test_capture_replays_without_loss(self):
+        handle,path=tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+        first,second=object(),object()
+        writer=CaptureWriter(path)
+        writer.record(first,CONNECT)
+        writer.record(second,CONNECT)
+        writer.record(first,DATA,b'from a')
+        writer.record(second,DATA,b'/search a')
+        writer.record(second,DATA,b'from b')
+        writer.record(first,CLOSE)
+        writer.record(second,CLOSE)
+        writer.close()
+        server=ServerProcess()
+        try:
+            with redirect_stdout(io.StringIO()):
+                results=Replay(path,0,port=server.port).run()
+        finally:
+            server.stop()
+            os.remove(path)
+        self.assertEqual(results['lost'],0)
+        self.assertEqual(results['messages'],3)
+        self.assertGreaterEqual(results['seconds'],max(results['latencies']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# turtle_chat_bench.py
+# Benchmarks for the UI path, run on the headless renderer so no display
+# is needed:
+#
+#   python turtle_chat_bench.py
+#
+# Reports time to construct a View, time per keystroke typed into the
+# TextBox, per block of text pasted into it, and per message received by the
+# View (one at a time, and in a flood drawn together).
+
+import io
+import sys
+import time
+from contextlib import redirect_stdout
+from turtle_chat_render import HeadlessRenderer
+from turtle_chat_view import View
+from turtle_chat_widgets import TextInput
+
+_SAMPLE_TEXT='Hello there, this is message 42. Are you still there? '
+_KEY_NAMES=dict((c,key) for key,c in TextInput._KEYMAP.items()) #Character -> Tk key name
+
+class NullClient:
+    '''
+    Client stand-in for benchmarks and tests: messages sent are only kept
+    in sent, and nothing is received.
+    '''
+    def __init__(self):
+        self.sent=[]
+
+    def send(self,msg):
+        self.sent.append(msg)
+
+    def has_pending(self):
+        return False
+
+    def flush(self,block=True):
+        return 0
+
+    def receive(self):
+        return None
+
+def make_view():
+    '''
+    :return: (View, HeadlessRenderer) pair, with startup work already run.
+    '''
+    renderer=HeadlessRenderer()
+    with redirect_stdout(io.StringIO()):
+        view=View(client=NullClient(),renderer=renderer)
+        renderer.run_pending()
+    return view,renderer
+
+def bench_startup(n=200):
+    '''
+    Construct n Views.
+
+    :return: (seconds per View, drawing calls per View)
+    '''
+    renderer=HeadlessRenderer()
+    with redirect_stdout(io.StringIO()):
+        start=time.perf_counter()
+        for i in range(n):
+            View(client=NullClient(),renderer=renderer)
+        elapsed=time.perf_counter()-start
+    return elapsed/n,len(renderer.ops)/n
+
+def keystrokes(text,n):
+    '''
+    :return: list of n key names that type out text, repeated as needed.
+    '''
+    return [_KEY_NAMES[c] for c in (text*(n//len(text)+1))[:n]]
+
+def bench_keystrokes(n=2000):
+    '''
+    Type n keys into the View's TextBox, letting each one be drawn.  The
+    TextBox is cleared whenever it is full, so every key adds a letter.
+
+    :return: (seconds per keystroke, drawing calls per keystroke)
+    '''
+    view,renderer=make_view()
+    keys=keystrokes(_SAMPLE_TEXT,n)
+    capacity=view.textbox.capacity()
+    renderer.ops=[]
+    with redirect_stdout(io.StringIO()):
+        start=time.perf_counter()
+        for i,key in enumerate(keys):
+            if i%capacity==0:
+                view.textbox.clear_msg()
+            renderer.press(key)
+            renderer.run_pending()
+        elapsed=time.perf_counter()-start
+    return elapsed/n,len(renderer.ops)/n
+
+def bench_paste(n=200,length=200):
+    '''
+    Paste n blocks of text into the View's TextBox, clearing it after each.
+
+    :param length: integer, letters in each pasted block.
+    :return: (seconds per paste, drawing calls per paste)
+    '''
+    view,renderer=make_view()
+    renderer.clipboard_text=(_SAMPLE_TEXT*(length//len(_SAMPLE_TEXT)+1))[:length]
+    renderer.ops=[]
+    start=time.perf_counter()
+    for i in range(n):
+        renderer.events['<Control-v>']()
+        renderer.run_pending()
+        view.textbox.clear_msg()
+    elapsed=time.perf_counter()-start
+    return elapsed/n,len(renderer.ops)/n
+
+def bench_messages(n=2000,flood=False):
+    '''
+    Deliver n incoming messages to the View.
+
+    :param flood: if False, each message is drawn before the next arrives;
+                  if True, all arrive first and are drawn together.
+    :return: (seconds per message, drawing calls per message)
+    '''
+    view,renderer=make_view()
+    renderer.ops=[]
+    with redirect_stdout(io.StringIO()):
+        start=time.perf_counter()
+        for i in range(n):
+            view.msg_received(_SAMPLE_TEXT+str(i))
+            if not flood:
+                renderer.run_pending()
+        renderer.run_pending()
+        elapsed=time.perf_counter()-start
+    return elapsed/n,len(renderer.ops)/n
+
+def report(name,result):
+    seconds,ops=result
+    print('%-28s %10.1f us %10.1f draw calls' % (name,seconds*1e6,ops))
+
+if __name__ == '__main__':
+    if len(sys.argv)>1:
+        n=int(sys.argv[1])
+    else:
+        n=2000
+    report('per View() startup',bench_startup(n//10))
+    report('per keystroke',bench_keystrokes(n))
+    report('per paste (200 letters)',bench_paste(n//10))
+    report('per message',bench_messages(n))
+    report('per message (flood)',bench_messages(n,flood=True))
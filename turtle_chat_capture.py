@@ -0,0 +1,63 @@
+# turtle_chat_capture.py
+# Capture files: the traffic a chat server receives, recorded by the server
+# (see turtle_chat_server) and played back by turtle_chat_replay.
+
+import time
+import struct
+
+RECORD=struct.Struct('!dIBI') #Record header: time, connection id, kind, data length
+CONNECT=0 #Record kinds: connection opened,
+DATA=1 #data received,
+CLOSE=2 #and connection closed.
+
+class CaptureWriter:
+    '''
+    Writes a capture file: one record per connection opened or closed and
+    per chunk of data received, stamped with the time and connection id.
+    Every record is flushed as it is written, so a server that is killed
+    leaves a complete capture.
+    '''
+    def __init__(self,path):
+        '''
+        :param path: string, name of the capture file (overwritten).
+        '''
+        self.file=open(path,'wb')
+        self.ids={} #socket -> connection id
+        self.next_id=0
+
+    def record(self,sock,kind,data=b''):
+        '''
+        :param sock: socket the event happened on.
+        :param kind: one of CONNECT, DATA or CLOSE.
+        :param data: bytes received, for DATA records.
+        '''
+        if kind==CONNECT:
+            self.ids[sock]=self.next_id
+            self.next_id+=1
+        conn_id=self.ids.get(sock)
+        if conn_id is None:
+            return
+        if kind==CLOSE:
+            del self.ids[sock]
+        self.file.write(RECORD.pack(time.time(),conn_id,kind,len(data))+data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_capture(path):
+    '''
+    :param path: string, name of a capture file.
+    :return: generator of (time, connection id, kind, data) tuples.  A
+             record cut short at the end of the file is ignored.
+    '''
+    with open(path,'rb') as f:
+        while True:
+            header=f.read(RECORD.size)
+            if len(header)<RECORD.size:
+                return
+            timestamp,conn_id,kind,length=RECORD.unpack(header)
+            data=f.read(length)
+            if len(data)<length:
+                return
+            yield timestamp,conn_id,kind,data
@@ -1,8 +1,11 @@
 # turtle_chat_client.py
 
+import os
 import sys
 import socket
 import select
+import struct
+from collections import deque
 
 class Client:
     '''
@@ -10,10 +13,13 @@ class Client:
     chat tool.
     '''
     _BUFFER_SIZE=4096 #Size of buffers for socket input/output
+    _SEND_CHUNK=65536 #Largest number of bytes handed to a single send call
+    _FLUSH_SIZE=4096 #Queued bytes at which send writes without waiting for flush
     _TIME_OUT=0.2 #Time to wait, in seconds, before timing out server
     _END_MSG='<\chat>' #Special message indicating end of session.
     _DEFAULT_PORT=9009 #Default port number
     _DEFAULT_HOST='localhost' #Default host (for communicating between sessions on one machine)
+    _FILE_PORT_OFFSET=1 #Files are transferred on the server's port number plus this
 
     def __init__(self,username='Me',partner_name='Partner',hostname=None,port=None):
         '''
@@ -40,6 +46,7 @@ class Client:
         
         self.username=username
         self.partner_name=partner_name
+        self._out_buffer=bytearray() #Bytes queued by send, waiting to be written
         #Create a new socket
         self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.settimeout(Client._TIME_OUT) #Wait _TIME_OUT seconds before deciding server has timed out
@@ -48,6 +55,8 @@ class Client:
         try :
             self.server.connect((self.hostname,self.port))
             print('Connected to '+self.hostname+' at port, '+str(self.port) +'. You can start sending messages.')
+            #From now on writes never wait: what the socket cannot take stays queued.
+            self.server.setblocking(False)
         except Exception as err:
             print('Unable to connect to '+self.hostname+' at port '+str(self.port))
             raise(err) #Give error to user for debugging purposes
@@ -57,9 +66,86 @@ class Client:
         '''
         Send string through socket.  Encode to bytes-like object.
 
+        If nothing is waiting to be written, the message is written at
+        once, without waiting for the socket.  Whatever the socket does
+        not take is queued, and written by later calls to flush or receive
+        (or by send, once _FLUSH_SIZE bytes are queued), so messages sent
+        while the connection is backed up go out together.  Call flush or
+        close before exiting to be sure everything has been delivered.
+
         :param msg: string to encode and send through socket belonging to this client.
         '''
-        self.server.send(msg.encode())
+        self.send_bytes(msg.encode())
+
+    def send_bytes(self, data):
+        '''
+        Queue bytes to be sent through socket, as they are - as send does
+        for strings.
+
+        :param data: bytes-like object to send.
+        '''
+        self._queue(data)
+
+    def send_many(self, msgs):
+        '''
+        Send several strings in one write.
+
+        Chat messages have no delimiter, so the server receives the
+        strings joined together and relays them as one message - end each
+        with a newline to keep them apart on screen.  Commands such as
+        /search are only recognised at the start of what is sent, so send
+        them on their own.
+
+        :param msgs: iterable of strings to send, in order.
+        '''
+        self._queue(b''.join(msg.encode() for msg in msgs))
+
+    def _queue(self, data):
+        '''
+        Add bytes to the outgoing buffer.  Write what the socket will take
+        now if nothing was queued before them, or once _FLUSH_SIZE bytes
+        are waiting.
+        '''
+        self._out_buffer+=data
+        if len(self._out_buffer) == len(data) or len(self._out_buffer) >= Client._FLUSH_SIZE :
+            self.flush(block=False)
+
+    def flush(self, block=True):
+        '''
+        Write the outgoing buffer to the socket.
+
+        :param block: boolean.  If True (default), wait until every queued
+                      byte has been written (like socket.sendall).  If False,
+                      write only what the socket accepts without waiting.
+        :return: number of bytes still waiting in the outgoing buffer.
+        '''
+        while len(self._out_buffer) != 0 :
+            if block :
+                select.select([], [self.server], [])
+            try :
+                #send may write only part of the buffer - keep the rest for later.
+                sent=self.server.send(self._out_buffer[:Client._SEND_CHUNK])
+            except BlockingIOError :
+                if block :
+                    continue
+                break
+            del self._out_buffer[:sent]
+        return len(self._out_buffer)
+
+    def close(self):
+        '''
+        Write everything still queued, then close the connection.
+        '''
+        try :
+            self.flush()
+        finally :
+            self.server.close()
+
+    def has_pending(self):
+        '''
+        :return: True if queued bytes are still waiting to be written.
+        '''
+        return len(self._out_buffer) != 0
 
     def receive(self):
         '''
@@ -67,6 +153,7 @@ class Client:
 
         :return: String received from partner, or None when chat session has terminated.
         '''
+        self.flush(block=False) #Push out anything send could not write yet
         ready_to_read,ready_to_write,in_error = select.select([self.server] , [], [],Client._TIME_OUT)
         
         if len(ready_to_read) != 0 :
@@ -84,17 +171,325 @@ class Client:
         else :
             return None
 
+    def upload(self, path, name=None):
+        '''
+        Share a file with the chat.  The file is streamed to the server on
+        a connection of its own, so chat messages are not held up.  Blocks
+        until the server has stored the whole file.
+
+        :param path: string, name of the file to send.
+        :param name: string, name to show the other participants.
+                     Default=None - the file's own name.
+        :return: integer id of the file on the server, for download.
+        '''
+        if name is None:
+            name=os.path.basename(path)
+        with socket.create_connection((self.hostname,self.port+Client._FILE_PORT_OFFSET)) as conn:
+            with open(path,'rb') as f:
+                size=os.fstat(f.fileno()).st_size
+                conn.sendall(('UPLOAD %d %s\n' % (size,name)).encode())
+                #Send the file only once the server has accepted it.
+                reply,rest=Client._read_line(conn)
+                if reply!='READY':
+                    raise ConnectionError('Upload failed: '+reply)
+                conn.sendfile(f)
+            reply,rest=Client._read_line(conn)
+        words=reply.split()
+        if len(words)!=2 or words[0]!='OK':
+            raise ConnectionError('Upload failed: '+reply)
+        return int(words[1])
+
+    def download(self, file_id, path):
+        '''
+        Fetch a shared file from the server and save it.  Blocks until the
+        whole file has arrived.
+
+        :param file_id: integer id of the file, as given in the chat.
+        :param path: string, name of the file to save to.
+        :return: string, the name the file was shared under.
+        '''
+        with socket.create_connection((self.hostname,self.port+Client._FILE_PORT_OFFSET)) as conn:
+            conn.sendall(('DOWNLOAD %d\n' % file_id).encode())
+            reply,data=Client._read_line(conn)
+            words=reply.split(' ',2)
+            if len(words)!=3 or words[0]!='OK':
+                raise ConnectionError('Download failed: '+reply)
+            remaining=int(words[1])
+            with open(path,'wb') as f:
+                while True:
+                    f.write(data[:remaining])
+                    remaining-=len(data[:remaining])
+                    if remaining==0:
+                        break
+                    data=conn.recv(Client._SEND_CHUNK)
+                    if len(data)==0:
+                        raise ConnectionError('Download of file %d ended early' % file_id)
+        return words[2]
+
+    @staticmethod
+    def _read_line(conn):
+        '''
+        Read a status line from a file transfer connection.
+
+        :return: (line without its newline, as a string; bytes received after it)
+        '''
+        data=b''
+        while b'\n' not in data:
+            chunk=conn.recv(Client._BUFFER_SIZE)
+            if len(chunk)==0:
+                break
+            data+=chunk
+        line,_,rest=data.partition(b'\n')
+        return line.decode(),rest
+
     def get_server(self):
         '''
         :return: socket connection to server of this client instance
         '''
         return self.server
 
+class MuxClient(Client):
+    '''
+    Client that carries many logical chat sessions over one connection.
+
+    Each session gets an id, and everything written to the socket is wrapped
+    in a frame carrying that id, so the server can treat every session as a
+    separate chat participant.  A single call to poll reads for all sessions.
+    '''
+    _HELLO=b'<\\mux>' #First bytes sent, telling the server to expect frames
+    _HEADER=struct.Struct('!IBI') #Frame header: session id, kind, payload length
+    _OPEN=0 #Frame kinds: session opened (payload is username),
+    _DATA=1 #chat message,
+    _CLOSE=2 #session closed,
+    _BROADCAST=3 #and message for every session but the one in the header.
+    _NO_SESSION=0xFFFFFFFF #Session id of a broadcast frame meant for every session
+    _MAX_READS=64 #Most socket reads done by one call to poll
+
+    def __init__(self,hostname=None,port=None):
+        '''
+        Initialize a new multiplexing client and connect to the server.
+
+        :param hostname: string, as in Client.  Default value='localhost'
+        :param port: integer, as in Client.  Default value=9009
+        '''
+        Client.__init__(self,hostname=hostname,port=port)
+        self.sessions={} #Maps session id to MuxSession
+        self.closed=False
+        self._next_id=0
+        self._in_buffer=bytearray() #Received bytes not yet parsed into frames
+        self._queue(MuxClient._HELLO)
+
+    @staticmethod
+    def pack_frame(session_id,kind,payload=b''):
+        '''
+        :param session_id: integer id of the logical session
+        :param kind: one of MuxClient._OPEN, _DATA, _CLOSE or _BROADCAST
+        :param payload: bytes carried by the frame
+        :return: bytes, header followed by payload
+        '''
+        return MuxClient._HEADER.pack(session_id,kind,len(payload))+payload
+
+    @staticmethod
+    def unpack_frames(buffer):
+        '''
+        Remove every complete frame from the front of buffer.
+
+        :param buffer: bytearray of received bytes; complete frames are
+                       deleted from it, a trailing partial frame is kept.
+        :return: list of (session_id, kind, payload) tuples
+        '''
+        frames=[]
+        start=0
+        header_size=MuxClient._HEADER.size
+        while len(buffer)-start >= header_size :
+            session_id,kind,length=MuxClient._HEADER.unpack_from(buffer,start)
+            end=start+header_size+length
+            if end > len(buffer) :
+                break
+            frames.append((session_id,kind,bytes(buffer[start+header_size:end])))
+            start=end
+        del buffer[:start]
+        return frames
+
+    def open_session(self,username='Me'):
+        '''
+        Start a new logical session on this connection.
+
+        :param username: string, name of the chat participant for this session.
+        :return: MuxSession object used to send and receive for the session.
+        '''
+        session=MuxSession(self,self._next_id,username)
+        self._next_id+=1
+        self.sessions[session.session_id]=session
+        self._queue(MuxClient.pack_frame(session.session_id,MuxClient._OPEN,username.encode()))
+        return session
+
+    def close_session(self,session_id):
+        '''
+        End a logical session.  The connection stays open for the others.
+
+        :param session_id: integer id of the session to close.
+        '''
+        if self.sessions.pop(session_id,None) is not None :
+            self._queue(MuxClient.pack_frame(session_id,MuxClient._CLOSE))
+
+    def send(self,msg):
+        '''
+        Send string on every open session.
+
+        :param msg: string to send.
+        '''
+        self.send_bytes(msg.encode())
+
+    def send_bytes(self,data,session_id=None):
+        '''
+        Send bytes as a chat message, framed like send - never written
+        to the connection as they are.
+
+        :param data: bytes-like object to send.
+        :param session_id: integer id of the sending session.
+                           Default=None - every open session.
+        '''
+        if session_id is None :
+            session_ids=self.sessions
+        else :
+            session_ids=[session_id]
+        self._queue(b''.join(MuxClient.pack_frame(i,MuxClient._DATA,bytes(data)) for i in session_ids))
+
+    def send_many(self,msgs,session_id=None):
+        '''
+        Queue several strings at once, each in a frame of its own.
+
+        :param msgs: iterable of strings to send, in order.
+        :param session_id: integer id of the sending session.
+                           Default=None - every open session.
+        '''
+        for msg in msgs :
+            self.send_bytes(msg.encode(),session_id)
+
+    def send_to(self,session_id,msg):
+        '''
+        Send string on one session.
+
+        :param session_id: integer id of the sending session.
+        :param msg: string to send.
+        '''
+        self.send_bytes(msg.encode(),session_id)
+
+    def poll(self,timeout=0):
+        '''
+        Read from the server once and hand incoming messages to their sessions.
+
+        :param timeout: seconds to wait for data; None waits until data arrives.
+                        Default=0 (do not wait).
+        :return: list of MuxSession objects that received new messages.
+        '''
+        self.flush(block=False)
+        if self.closed :
+            return []
+        #Keep reading while data is waiting, up to _MAX_READS reads, so
+        #a busy connection is drained in one call.
+        for i in range(MuxClient._MAX_READS) :
+            ready_to_read,ready_to_write,in_error = select.select([self.server], [], [], timeout)
+            if len(ready_to_read) == 0 :
+                break
+            try :
+                data=self.server.recv(Client._BUFFER_SIZE)
+            except ConnectionError : #Reset by the server: closed too.
+                data=b''
+            if len(data)==0 : #Remote end has closed.
+                self.closed=True
+                break
+            self._in_buffer+=data
+            timeout=0
+        updated={} #Session id -> session, for sessions given messages by a data frame
+        missed=None #Ids of sessions left out of every broadcast frame, once there is one
+        for session_id,kind,payload in MuxClient.unpack_frames(self._in_buffer) :
+            if kind == MuxClient._DATA :
+                session=self.sessions.get(session_id)
+                if session is not None :
+                    updated[session_id]=session
+                    session.inbox.append(payload.decode(errors='replace'))
+            elif kind == MuxClient._BROADCAST :
+                #One frame stands for a copy to each session but the sender.
+                msg=payload.decode(errors='replace')
+                for session in self.sessions.values() :
+                    session.inbox.append(msg)
+                sender=self.sessions.get(session_id)
+                if sender is not None :
+                    sender.inbox.pop()
+                if missed is None :
+                    missed={session_id}
+                else :
+                    missed&={session_id}
+        if missed is not None :
+            return [session for session_id,session in self.sessions.items()
+                    if session_id not in missed or session_id in updated]
+        return list(updated.values())
+
+    def receive_all(self):
+        '''
+        Poll for all sessions, waiting up to the usual client timeout.
+        Unlike Client.receive, this returns sessions rather than a message.
+
+        :return: list of MuxSession objects that received new messages,
+                 or Client._END_MSG when the connection has closed.
+        '''
+        updated=self.poll(Client._TIME_OUT)
+        if self.closed :
+            return Client._END_MSG
+        return updated
+
+class MuxSession:
+    '''
+    One logical chat session carried by a MuxClient.  Offers the same send
+    and receive methods as Client.
+    '''
+    def __init__(self,mux,session_id,username):
+        '''
+        :param mux: MuxClient that owns the connection.
+        :param session_id: integer id of this session on the connection.
+        :param username: string, name of chat participant.
+        '''
+        self.mux=mux
+        self.session_id=session_id
+        self.username=username
+        self.inbox=deque() #Messages received but not yet read
+
+    def send(self,msg):
+        '''
+        :param msg: string to send from this session.
+        '''
+        self.mux.send_to(self.session_id,msg)
+
+    def receive(self):
+        '''
+        Messages are read from the socket by MuxClient.poll - this only
+        takes the oldest one waiting for this session.
+
+        :return: String received, None if nothing is waiting, or
+                 Client._END_MSG when the connection has closed.
+        '''
+        if len(self.inbox) != 0 :
+            return self.inbox.popleft()
+        if self.mux.closed :
+            return Client._END_MSG
+        return None
+
+    def close(self):
+        self.mux.close_session(self.session_id)
+
 if __name__ == "__main__":
     my_client=Client()
     server_socket=my_client.get_server()
     while True :
-        ready_to_read,ready_to_write,in_error=select.select([sys.stdin, server_socket],[],[])
+        if my_client.has_pending() :
+            write_list=[server_socket]
+        else :
+            write_list=[]
+        ready_to_read,ready_to_write,in_error=select.select([sys.stdin, server_socket],write_list,[])
+        if len(ready_to_write) != 0 :
+            my_client.flush(block=False)
         for my_socket in ready_to_read :
             if my_socket == server_socket :
                 new_msg=my_client.receive()
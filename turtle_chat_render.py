@@ -0,0 +1,156 @@
+# turtle_chat_render.py
+
+import tkinter
+import turtle
+from types import SimpleNamespace
+
+class TurtleRenderer:
+    '''
+    Rendering backend that draws with the turtle module.  This is the
+    backend widgets and views use unless they are given another one.
+    '''
+    def new_pen(self):
+        '''
+        :return: a new turtle, cloned from the default turtle.
+        '''
+        return turtle.clone()
+
+    def addshape(self,shape):
+        turtle.addshape(shape)
+
+    def setup(self,width,height):
+        turtle.setup(width=width,height=height)
+
+    def onkeypress(self,fun,key):
+        turtle.onkeypress(fun,key)
+
+    def listen(self):
+        turtle.listen()
+
+    def bind(self,sequence,fun):
+        '''
+        Bind a Tk event sequence (e.g. '<MouseWheel>') on the drawing canvas.
+        '''
+        turtle.getcanvas().bind(sequence,fun)
+
+    def tracer(self,n=None):
+        if n is None:
+            return turtle.tracer()
+        turtle.tracer(n)
+
+    def update(self):
+        turtle.update()
+
+    def ontimer(self,fun,t=0):
+        turtle.ontimer(fun,t)
+
+    def after_idle(self,fun):
+        turtle.getcanvas().after_idle(fun)
+
+    def root(self):
+        '''
+        :return: the Tk toplevel window, for registering event handlers.
+        '''
+        return turtle.getcanvas().winfo_toplevel()
+
+    def clipboard(self):
+        '''
+        :return: text on the clipboard, or '' if it holds no text.
+        '''
+        try:
+            return turtle.getcanvas().clipboard_get()
+        except tkinter.TclError:
+            return ''
+
+class RecordingPen:
+    '''
+    Stand-in for a turtle that records every call made on it instead of
+    drawing.  Any turtle method can be called on it.
+    '''
+    def __init__(self,renderer,pen_id):
+        self.renderer=renderer
+        self.pen_id=pen_id
+
+    def __getattr__(self,name):
+        def record(*args,**kwargs):
+            self.renderer.ops.append((self.pen_id,name,args))
+        return record
+
+class HeadlessRenderer:
+    '''
+    Rendering backend that needs no display.  Drawing calls are recorded
+    in ops, key and event handlers are kept so tests and benchmarks can
+    trigger them, and timer/idle callbacks wait in a queue until
+    run_pending is called - standing in for the Tk event loop.
+    '''
+    def __init__(self):
+        self.ops=[] #(pen id, method name, args) for every drawing call
+        self.keys={} #Key name -> handler registered with onkeypress
+        self.events={} #Event sequence -> handler registered with bind
+        self.pending=[] #Callbacks queued by ontimer and after_idle
+        self.tracing=1
+        self.pens=0
+        self.clipboard_text='' #Returned by clipboard, set it to test pasting
+
+    def new_pen(self):
+        self.pens+=1
+        return RecordingPen(self,self.pens)
+
+    def addshape(self,shape):
+        self.ops.append((None,'addshape',(shape,)))
+
+    def setup(self,width,height):
+        self.ops.append((None,'setup',(width,height)))
+
+    def onkeypress(self,fun,key):
+        self.keys[key]=fun
+
+    def listen(self):
+        pass
+
+    def bind(self,sequence,fun):
+        self.events[sequence]=fun
+
+    def tracer(self,n=None):
+        if n is None:
+            return self.tracing
+        self.tracing=n
+
+    def update(self):
+        self.ops.append((None,'update',()))
+
+    def ontimer(self,fun,t=0):
+        self.pending.append(fun)
+
+    def after_idle(self,fun):
+        self.pending.append(fun)
+
+    def root(self):
+        return None
+
+    def clipboard(self):
+        return self.clipboard_text
+
+    def press(self,key):
+        '''
+        Call the handler registered for key, as a key press would.
+
+        Keys without their own handler go to the '<KeyPress>' binding,
+        as they would in Tk.
+
+        :param key: Tk key name, e.g. 'a', 'space' or 'Return'.
+        '''
+        if key in self.keys:
+            self.keys[key]()
+        else:
+            self.events['<KeyPress>'](SimpleNamespace(keysym=key))
+
+    def run_pending(self):
+        '''
+        Run queued timer and idle callbacks, including any they queue.
+        '''
+        while len(self.pending)!=0:
+            pending=self.pending
+            self.pending=[]
+            for fun in pending:
+                fun()
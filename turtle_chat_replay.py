@@ -0,0 +1,281 @@
+# turtle_chat_replay.py
+# Record the traffic a chat server receives, and play it back against a
+# server to measure throughput and delivery latency.
+#
+# Record, by starting the server with a capture file:
+#
+#   python turtle_chat_server.py traffic.cap
+#
+# Replay at recorded speed (1), N times faster (N), or as fast as possible (0):
+#
+#   python turtle_chat_replay.py traffic.cap [speed] [host] [port]
+
+import io
+import re
+import sys
+import time
+import select
+import socket
+from collections import deque, Counter
+from contextlib import redirect_stdout
+from turtle_chat_client import Client, MuxClient
+from turtle_chat_capture import CLOSE, DATA, read_capture
+
+_DRAIN_TIME=2.0 #Seconds to wait after the last record for messages still in flight
+_JOIN_TIME=0.01 #Records on a connection this close together may reach the server as one read
+#Notices the server sends about other participants, which are skipped
+_NOTICE=re.compile(rb"(\[[^\]\n]*\] entered our chat session|Client \([^)\n]*\) is offline|"
+                   rb"[^\n]* entered our chat session|[^\n]* is offline|"
+                   rb"File #\d+ '[^\n]*' \(\d+ bytes\) shared)\n")
+
+class Replay:
+    '''
+    Plays a capture back against a server.  Each recorded connection gets
+    its own Client, and an extra observer Client, which sends nothing,
+    watches for the relayed messages to measure delivery latency.
+    '''
+    def __init__(self,path,speed=1.0,hostname=None,port=None):
+        '''
+        :param path: string, name of the capture file.
+        :param speed: number, playback speed relative to the recording;
+                      0 means as fast as possible.  Default=1.0
+        :param hostname: string, server host.  Default as in Client.
+        :param port: integer, server port.  Default as in Client.
+        '''
+        self.path=path
+        self.speed=speed
+        self.hostname=hostname
+        self.port=port
+        self.clients={} #connection id -> Client
+        self.closing=[] #Sockets of replayed connections that have been half-closed
+        self.seen=set() #Connection ids that have sent data
+        self.mux_buffers={} #connection id -> unparsed frames, for multiplexed connections
+        self.expected={} #message bytes -> times sent, waiting for the observer
+        self.lengths=Counter() #Lengths of the messages waiting, and how many have each
+        self.optional=0 #Messages waiting that the server may rightly never relay
+        self.search_runs={} #connection id -> time of its last record, while they may join a search
+        self.unexpected=0 #Bytes the observer received that matched nothing
+        self.notice_starts=[b'[',b'Client (',b'File #'] #How notices can begin; usernames are added
+        self.received=bytearray() #Bytes seen by the observer, not yet matched
+        self.latencies=[]
+        self.last_delivery=None #perf_counter time the observer last matched a message
+        self.messages=0
+        self.bytes_sent=0
+
+    def connect(self):
+        '''
+        :return: a new Client connected to the server, without its greeting.
+        '''
+        with redirect_stdout(io.StringIO()):
+            return Client(hostname=self.hostname,port=self.port)
+
+    def run(self):
+        '''
+        Replay the capture.
+
+        :return: dictionary of results - see report.
+        '''
+        self.observer=self.connect()
+        start=time.perf_counter()
+        first=None
+        for timestamp,conn_id,kind,data in read_capture(self.path):
+            if first is None:
+                first=timestamp
+            if self.speed>0:
+                self.pump(start+(timestamp-first)/self.speed)
+            if kind==CLOSE:
+                if conn_id in self.clients:
+                    #Half-close and keep reading until the server closes too:
+                    #closing with unread data would reset the connection and
+                    #could lose what the server has not read yet.
+                    client=self.clients.pop(conn_id)
+                    client.flush()
+                    client.get_server().shutdown(socket.SHUT_WR)
+                    self.closing.append(client.get_server())
+                continue
+            if conn_id not in self.clients:
+                self.clients[conn_id]=self.connect()
+            if kind==DATA:
+                self.send(conn_id,data)
+            self.pump(0)
+        for client in self.clients.values():
+            client.flush()
+        sent=time.perf_counter()
+        deadline=sent+_DRAIN_TIME
+        while self.waiting()!=0 and time.perf_counter()<deadline:
+            self.pump(time.perf_counter()+0.05)
+        #Throughput counts until the server delivered the last message seen.
+        finished=self.last_delivery if self.last_delivery is not None else sent
+        return {'messages':self.messages,
+                'bytes':self.bytes_sent,
+                'seconds':finished-start,
+                'send_seconds':sent-start,
+                'delivered':len(self.latencies),
+                'lost':self.waiting(),
+                'unexpected':self.unexpected,
+                'latencies':sorted(self.latencies)}
+
+    def send(self,conn_id,data):
+        '''
+        Send a recorded chunk of data, and note the chat messages in it
+        that the observer should receive.
+        '''
+        self.note(conn_id,data,time.perf_counter())
+        #Each record is one read by the server - write it out as one.
+        self.clients[conn_id].send_bytes(data)
+        self.clients[conn_id].flush(block=False)
+        self.messages+=1
+        self.bytes_sent+=len(data)
+
+    def note(self,conn_id,data,now):
+        '''
+        Note the chat messages in a chunk of data sent at time now that
+        the observer should receive.
+
+        A search command is answered, not relayed, when the server reads
+        it at the start of a read - but joined to what came before it, it
+        is relayed as chat.  And data read joined to the end of a search
+        command is taken as part of the search.  Messages in either case
+        are matched if they arrive, but not missed if they do not.
+        '''
+        frames=data
+        if conn_id not in self.seen:
+            self.seen.add(conn_id)
+            #A multiplexing client's first bytes announce it, as the server sees them.
+            if data.startswith(MuxClient._HELLO):
+                self.mux_buffers[conn_id]=bytearray()
+                frames=data[len(MuxClient._HELLO):]
+        if conn_id in self.mux_buffers:
+            buffer=self.mux_buffers[conn_id]
+            buffer+=frames
+            #Frames are never joined: a search frame is always answered.
+            for session,kind,payload in MuxClient.unpack_frames(buffer):
+                if kind==MuxClient._DATA and not payload.startswith(b'/search'):
+                    self.expect(payload,now)
+                elif kind==MuxClient._OPEN:
+                    self.notice_starts.append(payload)
+            return
+        last=self.search_runs.pop(conn_id,None)
+        joined=last is not None and now-last<_JOIN_TIME
+        search=data.startswith(b'/search')
+        self.expect(data,now,optional=joined or search)
+        if joined or search:
+            self.search_runs[conn_id]=now
+
+    def expect(self,message,now,optional=False):
+        '''
+        :param message: bytes the observer should receive.
+        :param now: perf_counter time the message was sent.
+        :param optional: True if the server may rightly never relay it.
+        '''
+        self.expected.setdefault(bytes(message),deque()).append((now,optional))
+        self.lengths[len(message)]+=1
+        if optional:
+            self.optional+=1
+
+    def waiting(self):
+        '''
+        :return: number of messages the observer has yet to receive.
+        '''
+        return sum(self.lengths.values())-self.optional
+
+    def pump(self,until):
+        '''
+        Read from every connection until the time until (a perf_counter
+        value) is reached, or once if it has already passed.  Data for
+        replayed clients is thrown away; data for the observer is matched
+        against the messages expected.
+        '''
+        sockets=[client.get_server() for client in self.clients.values()]+self.closing
+        observer=self.observer.get_server()
+        sockets.append(observer)
+        while True:
+            wait=max(0,until-time.perf_counter())
+            ready_to_read,ready_to_write,in_error=select.select(sockets,[],[],wait)
+            for sock in ready_to_read:
+                data=sock.recv(Client._BUFFER_SIZE*16)
+                if sock==observer and len(data)!=0:
+                    self.received+=data
+                    self.match(time.perf_counter())
+                elif len(data)==0:
+                    sockets.remove(sock)
+                    if sock in self.closing:
+                        self.closing.remove(sock)
+                        sock.close()
+            if time.perf_counter()>=until:
+                return
+
+    def match(self,now):
+        '''
+        Take complete messages off the front of the observer's data.  A
+        message is matched to an expected one it starts with, trying each
+        length of message expected, and server notices are skipped.  Data
+        that is neither is dropped a byte at a time, once enough has
+        arrived to be sure it is not the start of one of them.
+        '''
+        while len(self.received)!=0:
+            for length in self.lengths:
+                if length>len(self.received):
+                    continue
+                message=bytes(self.received[:length])
+                if message in self.expected:
+                    times=self.expected[message]
+                    sent,optional=times.popleft()
+                    self.latencies.append(now-sent)
+                    self.last_delivery=now
+                    if len(times)==0:
+                        del self.expected[message]
+                    self.lengths[length]-=1
+                    if self.lengths[length]==0:
+                        del self.lengths[length]
+                    if optional:
+                        self.optional-=1
+                    del self.received[:length]
+                    break
+            else:
+                notice=_NOTICE.match(self.received)
+                if notice:
+                    del self.received[:notice.end()]
+                elif self.incomplete():
+                    return #Wait for the rest of a notice or message
+                else:
+                    del self.received[:1]
+                    self.unexpected+=1
+
+    def incomplete(self):
+        '''
+        :return: True if the observer's data could be the start of an
+                 expected message or a notice that has not all arrived.
+        '''
+        received=bytes(self.received)
+        if b'\n' not in received:
+            for start in self.notice_starts:
+                if received.startswith(start) or start.startswith(received):
+                    return True
+        return any(len(message)>len(received) and message.startswith(received)
+                   for message in self.expected)
+
+def report(results):
+    '''
+    Print throughput and latency figures from Replay.run.
+    '''
+    latencies=results['latencies']
+    print('Replayed %d messages (%d bytes) in %.3f s: %.0f msg/s, %.2f MB/s' %
+          (results['messages'],results['bytes'],results['seconds'],
+           results['messages']/max(results['seconds'],1e-9),
+           results['bytes']/max(results['seconds'],1e-9)/1e6))
+    print('(all sent in %.3f s; the time above runs to the last delivery)' % results['send_seconds'])
+    print('Delivered %d, not seen by observer %d, unexpected bytes %d' %
+          (results['delivered'],results['lost'],results['unexpected']))
+    if len(latencies)!=0:
+        print('Latency ms: p50 %.2f  p95 %.2f  max %.2f' %
+              (latencies[len(latencies)//2]*1e3,
+               latencies[min(len(latencies)-1,int(len(latencies)*0.95))]*1e3,
+               latencies[-1]*1e3))
+
+if __name__ == '__main__':
+    path=sys.argv[1]
+    speed=float(sys.argv[2]) if len(sys.argv)>2 else 1.0
+    hostname=sys.argv[3] if len(sys.argv)>3 else None
+    port=int(sys.argv[4]) if len(sys.argv)>4 else None
+    report(Replay(path,speed,hostname,port).run())
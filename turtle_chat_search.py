@@ -0,0 +1,128 @@
+# turtle_chat_search.py
+
+import re
+import math
+import heapq
+from array import array
+
+class Segment:
+    '''
+    A block of consecutive messages and the inverted index over them.
+    Posting lists are arrays of message ids (in increasing order) with a
+    parallel array of how often the token occurs in each message.
+    '''
+    def __init__(self,first_id):
+        '''
+        :param first_id: integer id of the first message in this segment.
+        '''
+        self.first_id=first_id
+        self.messages=[] #Message text, indexed by id-first_id
+        self.postings={} #token -> array of message ids
+        self.counts={} #token -> array of occurrence counts, parallel to postings
+
+    def add(self,msg_id,tokens):
+        '''
+        :param msg_id: integer id of the message; larger than any id added before.
+        :param tokens: list of tokens in the message.
+        '''
+        seen={}
+        for token in tokens:
+            seen[token]=seen.get(token,0)+1
+        for token,count in seen.items():
+            if token not in self.postings:
+                self.postings[token]=array('I')
+                self.counts[token]=array('B')
+            self.postings[token].append(msg_id)
+            self.counts[token].append(min(count,255))
+
+class SearchIndex:
+    '''
+    Incremental full-text index over chat messages.
+
+    Messages are numbered in the order they are added and grouped into
+    segments of segment_size messages.  Once there are more than
+    max_segments segments, the oldest one is dropped, so memory stays
+    bounded and searches cover the most recent messages only.
+    '''
+    _TOKEN=re.compile(r'\w+')
+
+    def __init__(self,segment_size=1024,max_segments=64):
+        '''
+        :param segment_size: integer, messages per segment.  Default=1024
+        :param max_segments: integer, segments kept before the oldest is
+                             evicted.  Default=64
+        '''
+        self.segment_size=segment_size
+        self.max_segments=max_segments
+        self.segments=[Segment(0)]
+        self.next_id=0
+
+    @staticmethod
+    def tokenize(text):
+        '''
+        :return: list of lower-case words in text.
+        '''
+        return SearchIndex._TOKEN.findall(text.lower())
+
+    def add(self,text):
+        '''
+        Index a message.
+
+        :param text: string, the message.
+        :return: integer id given to the message.
+        '''
+        segment=self.segments[-1]
+        if len(segment.messages)==self.segment_size:
+            segment=Segment(self.next_id)
+            self.segments.append(segment)
+            if len(self.segments)>self.max_segments:
+                del self.segments[0]
+        msg_id=self.next_id
+        self.next_id+=1
+        segment.messages.append(text)
+        segment.add(msg_id,SearchIndex.tokenize(text))
+        return msg_id
+
+    def get(self,msg_id):
+        '''
+        :return: text of message msg_id, or None if it has been evicted.
+        '''
+        #Every segment but the last is full, so the segment is found by division.
+        i=(msg_id-self.segments[0].first_id)//self.segment_size
+        if i<0 or i>=len(self.segments):
+            return None
+        segment=self.segments[i]
+        if msg_id-segment.first_id>=len(segment.messages):
+            return None
+        return segment.messages[msg_id-segment.first_id]
+
+    def search(self,query,page=1,page_size=10):
+        '''
+        Find messages containing words of query.  Messages matching more
+        of the query's words rank first, then by tf-idf score, then the
+        newest first.
+
+        :param query: string of words to search for.
+        :param page: integer, page of results to return, starting at 1.
+        :param page_size: integer, results per page.
+        :return: (total, results) - total number of matching messages, and
+                 a list of (message id, text) pairs for the requested page.
+        '''
+        tokens=set(SearchIndex.tokenize(query))
+        total_messages=sum(len(segment.messages) for segment in self.segments)
+        scores={} #message id -> [words matched, tf-idf score]
+        for token in tokens:
+            found=[segment for segment in self.segments if token in segment.postings]
+            df=sum(len(segment.postings[token]) for segment in found)
+            if df==0:
+                continue
+            idf=math.log(1+total_messages/df)
+            for segment in found:
+                for msg_id,count in zip(segment.postings[token],segment.counts[token]):
+                    score=scores.setdefault(msg_id,[0,0.0])
+                    score[0]+=1
+                    score[1]+=count*idf
+        #Only the pages up to the one asked for need ranking.
+        start=(page-1)*page_size
+        ranked=heapq.nlargest(start+page_size,scores,key=lambda msg_id:(scores[msg_id][0],scores[msg_id][1],msg_id))
+        return len(scores),[(msg_id,self.get(msg_id)) for msg_id in ranked[start:]]
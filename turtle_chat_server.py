@@ -1,78 +1,451 @@
 # Server for turtle_chat
-import sys, socket, select
+import sys, os, socket, select, re, tempfile, shutil, signal
+from collections import deque
+from turtle_chat_client import MuxClient
+from turtle_chat_search import SearchIndex
+import turtle_chat_capture
 
 DEFAULT_HOST = 'localhost'
 SOCKET_LIST = []
+NEW_SOCKETS = {}   # connection not yet known to be multiplexed -> bytes received
+MUX_SESSIONS = {}  # multiplexed connection -> {session id: username}
+MUX_BUFFERS = {}   # multiplexed connection -> bytes not yet parsed into frames
 RECV_BUFFER = 4096 
 DEFAULT_PORT = 9009
+SEARCH_INDEX = SearchIndex()  # every chat message relayed, for /search
+# "/search hello world" gives page 1 of results, "/search hello world #2" page 2
+SEARCH_COMMAND = re.compile(r'^/search\b(?:\s+(?!#\d)(.*?))?(?:\s+#(\d+))?\s*$', re.DOTALL)
+SEARCH_USAGE = "Usage: /search words [#page]\n"
+SEARCH_PAGE_SIZE = 10
+CAPTURE = None  # CaptureWriter recording inbound traffic, when capturing
+TRANSFER_SOCKETS = []  # file port listening socket and its connections
+TRANSFERS = {}    # file port connection -> Transfer
+ATTACHMENTS = {}  # file id -> (spool file path, file name, size)
+SPOOL_DIR = None  # directory uploaded files are kept in
+TRANSFER_CHUNK = 65536  # most bytes moved per transfer on each pass of the loop
+MAX_HEADER = 1024  # longest request line accepted on the file port
+MAX_ATTACHMENT = 64 * 1024 * 1024  # largest file accepted, bytes
+MAX_ATTACHMENTS = 100  # files kept; the oldest is deleted when exceeded
+OUTBOX = {}  # chat connection -> OutboundQueue of data waiting to be written
+# priority classes of outgoing chat traffic, and their share of each connection
+CONTROL, INTERACTIVE, BULK = 0, 1, 2  # presence notices; chat; search results
+WEIGHTS = (8, 4, 1)
+QUANTUM = 4096  # bytes a class of weight 1 may write per round
+SEND_CHUNK = 8192  # bytes chosen for writing at a time; nothing overtakes them
+SEND_BUDGET = 65536  # most bytes written to one connection per pass of the loop
+MAX_OUTBOX = 4 * 1024 * 1024  # a client this far behind is disconnected
 
-def chat_server(HOST=DEFAULT_HOST, PORT=DEFAULT_PORT):
+def chat_server(HOST=DEFAULT_HOST, PORT=DEFAULT_PORT, capture=None, FILE_PORT=None):
     '''
     Run this method in main to spawn a new server.
 
     :param HOST: hostname, string.  Default='localhost'.
     :param PORT: port number, integer.  Default=9009
+    :param capture: string, name of a file to record all inbound traffic to,
+                    for playing back with turtle_chat_replay.  Default=None
+    :param FILE_PORT: port number for file transfers, integer.  Default=PORT+1
     '''
+    global CAPTURE, SPOOL_DIR
+    if capture:
+        CAPTURE = turtle_chat_capture.CaptureWriter(capture)
+        print("Capturing traffic to " + capture)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((HOST, PORT))
     server_socket.listen(10)
  
+    # attachments are uploaded and downloaded on their own connections,
+    # to a second port, so they never share a socket with chat messages
+    if FILE_PORT is None:
+        FILE_PORT = PORT + 1
+    file_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    file_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    file_socket.bind((HOST, FILE_PORT))
+    file_socket.listen(10)
+    SPOOL_DIR = tempfile.mkdtemp(prefix='turtle_chat_')
+ 
     # add server socket object to the list of readable connections
     SOCKET_LIST.append(server_socket)
+    TRANSFER_SOCKETS.append(file_socket)
  
-    print("Chat server started on port " + str(PORT))
+    print("Chat server started on port " + str(PORT) + ", files on port " + str(FILE_PORT))
  
+    try:
+        serve(server_socket, file_socket)
+    finally:
+        if CAPTURE:
+            CAPTURE.close()
+        # uploaded files live only as long as the server
+        shutil.rmtree(SPOOL_DIR, ignore_errors=True)
+    server_socket.close()
+    file_socket.close()
+
+# the server's main loop
+def serve (server_socket, file_socket):
     while True:
 
-        # get the list of sockets which are ready to be read through select
-        # 4th arg, time_out  = 0 : poll and never block
-        ready_to_read,ready_to_write,in_error = select.select(SOCKET_LIST,[],[],0)
+        # get the list of sockets which are ready to be read through select,
+        # and the connections waiting to write; block until one is ready
+        sending = [sock for sock in TRANSFERS if TRANSFERS[sock].sending()]
+        sending += [sock for sock in OUTBOX if OUTBOX[sock].pending()]
+        ready_to_read,ready_to_write,in_error = select.select(SOCKET_LIST + TRANSFER_SOCKETS, sending, [])
+
+        # file transfers move at most TRANSFER_CHUNK bytes each per pass,
+        # so chat messages are never stuck behind a large file
+        for sock in ready_to_write:
+            if sock in TRANSFERS:
+                transfer_write(sock)
+            elif sock in OUTBOX:
+                flush_outbox(server_socket, sock)
+        for sock in ready_to_read:
+            if sock == file_socket:
+                sockfd, addr = file_socket.accept()
+                sockfd.setblocking(False)
+                TRANSFER_SOCKETS.append(sockfd)
+                TRANSFERS[sockfd] = Transfer()
+            elif sock in TRANSFERS:
+                transfer_read(server_socket, sock)
+        ready_to_read = [sock for sock in ready_to_read if sock not in TRANSFER_SOCKETS]
       
         for sock in ready_to_read:
+            # skip sockets dropped (by broadcast) earlier in this pass
+            if sock not in SOCKET_LIST:
+                continue
             # a new connection request recieved
             if sock == server_socket: 
                 sockfd, addr = server_socket.accept()
+                sockfd.setblocking(False)
                 SOCKET_LIST.append(sockfd)
+                NEW_SOCKETS[sockfd] = b''
+                OUTBOX[sockfd] = OutboundQueue()
                 print("Client (%s, %s) connected" % addr)
-                broadcast(server_socket, sockfd, "[%s:%s] entered our chat session\n" % addr)
+                if CAPTURE:
+                    CAPTURE.record(sockfd, turtle_chat_capture.CONNECT)
+                broadcast(server_socket, sockfd, "[%s:%s] entered our chat session\n" % addr, priority=CONTROL)
 
             # a message from a client, not a new connection
             else:
                 # process data recieved from client, 
                 # receiving data from the socket.
-                data = sock.recv(RECV_BUFFER)
-                if data:
-                    print(data.decode())
+                try:
+                    data = sock.recv(RECV_BUFFER)
+                except ConnectionError:
+                    # reset by the client: treat as a closed connection
+                    data = b''
+                closed = not data
+                if CAPTURE:
+                    if closed:
+                        CAPTURE.record(sock, turtle_chat_capture.CLOSE)
+                    else:
+                        CAPTURE.record(sock, turtle_chat_capture.DATA, data)
+                if data and sock in NEW_SOCKETS:
+                    data = NEW_SOCKETS.pop(sock) + data
+                    # a multiplexing client announces itself with its first
+                    # bytes, which may arrive over several reads
+                    if len(data) < len(MuxClient._HELLO) and MuxClient._HELLO.startswith(data):
+                        NEW_SOCKETS[sock] = data
+                        continue
+                    if data.startswith(MuxClient._HELLO):
+                        MUX_SESSIONS[sock] = {}
+                        MUX_BUFFERS[sock] = bytearray()
+                        data = data[len(MuxClient._HELLO):]
+                if sock in MUX_SESSIONS:
+                    if closed:
+                        remove_socket(server_socket, sock)
+                    else:
+                        demultiplex(server_socket, sock, data)
+                elif data:
+                    print(data.decode(errors='replace'))
                     # there is something in the socket
                     #Need to decode data to combine with string
                     #broadcast(server_socket, sock, "\r" + '[' + str(sock.getpeername()) + '] ' + data.decode())  
-                    broadcast(server_socket, sock, data.decode())  
+                    chat_message(server_socket, sock, data.decode(errors='replace'))
                 else:
                     # remove the socket that's broken    
-                    if sock in SOCKET_LIST:
-                        SOCKET_LIST.remove(sock)
+                    remove_socket(server_socket, sock)
 
                     # at this stage, no data means probably the connection has been broken
-                    broadcast(server_socket, sock, "Client (%s, %s) is offline\n" % addr) 
-
-    server_socket.close()
+                    broadcast(server_socket, sock, "Client (%s, %s) is offline\n" % addr, priority=CONTROL)
     
+# state of one connection on the file port
+class Transfer:
+    def __init__(self):
+        self.header = bytearray()  # request line, until it is complete
+        self.kind = None  # b'UPLOAD' or b'DOWNLOAD', once the request line is read
+        self.name = None
+        self.file = None
+        self.size = 0
+        self.remaining = 0  # bytes still to receive (upload) or send (download)
+        self.offset = 0  # position in the file of the next byte to send
+        self.reply = b''  # status line still to be written
+
+    def sending(self):
+        return bool(self.reply) or (self.kind == b'DOWNLOAD' and self.remaining > 0)
+
+    # nothing left to write, and no upload still to read
+    def finished(self):
+        return not self.sending() and not (self.kind == b'UPLOAD' and self.file is not None)
+
+# read from a file port connection: the request line, then upload data
+def transfer_read (server_socket, sock):
+    transfer = TRANSFERS[sock]
+    try:
+        data = sock.recv(TRANSFER_CHUNK)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        data = b''
+    if not data:
+        close_transfer(sock)
+        return
+    if transfer.kind is None:
+        transfer.header += data
+        if b'\n' not in transfer.header:
+            if len(transfer.header) > MAX_HEADER:
+                close_transfer(sock)
+            return
+        line, _, data = bytes(transfer.header).partition(b'\n')
+        start_transfer(transfer, line)
+    # the upload's file is set to None once it is complete
+    if transfer.kind == b'UPLOAD' and transfer.file is not None:
+        data = data[:transfer.remaining]
+        transfer.file.write(data)
+        transfer.remaining -= len(data)
+        if transfer.remaining == 0:
+            file_id = store_attachment(transfer)
+            transfer.reply = b'OK %d\n' % file_id
+            broadcast(server_socket, sock, "File #%d '%s' (%d bytes) shared\n" % (file_id, transfer.name, transfer.size), priority=CONTROL)
+
+# act on a request line: "UPLOAD <size> <name>" or "DOWNLOAD <id>"
+def start_transfer (transfer, line):
+    words = line.decode(errors='replace').split(' ', 2)
+    if len(words) == 3 and words[0] == 'UPLOAD' and words[1].isdigit():
+        transfer.size = int(words[1])
+        if transfer.size > MAX_ATTACHMENT:
+            transfer.reply = b'ERROR file too large\n'
+            transfer.kind = b'ERROR'
+            return
+        transfer.kind = b'UPLOAD'
+        transfer.name = os.path.basename(words[2].strip()) or 'file'
+        transfer.file = tempfile.NamedTemporaryFile(dir=SPOOL_DIR, delete=False)
+        transfer.remaining = transfer.size
+        # the client sends the file only once it is accepted
+        transfer.reply = b'READY\n'
+    elif len(words) == 2 and words[0] == 'DOWNLOAD' and words[1].isdigit() and int(words[1]) in ATTACHMENTS:
+        path, name, size = ATTACHMENTS[int(words[1])]
+        transfer.kind = b'DOWNLOAD'
+        transfer.file = open(path, 'rb')
+        transfer.size = transfer.remaining = size
+        transfer.reply = ('OK %d %s\n' % (size, name)).encode()
+    else:
+        transfer.kind = b'ERROR'
+        transfer.reply = b'ERROR bad request\n'
+
+# keep a finished upload, dropping the oldest file if there are too many
+def store_attachment (transfer):
+    transfer.file.close()
+    file_id = max(ATTACHMENTS, default=0) + 1
+    ATTACHMENTS[file_id] = (transfer.file.name, transfer.name, transfer.size)
+    transfer.file = None
+    if len(ATTACHMENTS) > MAX_ATTACHMENTS:
+        oldest = min(ATTACHMENTS)
+        os.remove(ATTACHMENTS.pop(oldest)[0])
+    return file_id
+
+# write to a file port connection: the status line, then the file itself,
+# which goes from the file to the socket without passing through Python
+def transfer_write (sock):
+    transfer = TRANSFERS[sock]
+    try:
+        if transfer.reply:
+            sent = sock.send(transfer.reply)
+            transfer.reply = transfer.reply[sent:]
+        elif transfer.kind == b'DOWNLOAD' and transfer.remaining > 0:
+            count = min(TRANSFER_CHUNK, transfer.remaining)
+            if hasattr(os, 'sendfile'):
+                sent = os.sendfile(sock.fileno(), transfer.file.fileno(), transfer.offset, count)
+            else:
+                transfer.file.seek(transfer.offset)
+                sent = sock.send(transfer.file.read(count))
+            if sent == 0:
+                # the file ended before its recorded size: give up on it
+                close_transfer(sock)
+                return
+            transfer.offset += sent
+            transfer.remaining -= sent
+    except BlockingIOError:
+        return
+    except OSError:
+        close_transfer(sock)
+        return
+    # everything written: a download, answered upload or refused request is done
+    if transfer.finished():
+        close_transfer(sock)
+
+# forget a file port connection; an unfinished upload is thrown away
+def close_transfer (sock):
+    transfer = TRANSFERS.pop(sock)
+    TRANSFER_SOCKETS.remove(sock)
+    sock.close()
+    if transfer.file:
+        transfer.file.close()
+        if transfer.kind == b'UPLOAD':
+            os.remove(transfer.file.name)
+
+# split data from a multiplexed connection into frames and act on each one
+def demultiplex (server_socket, sock, data):
+    buffer = MUX_BUFFERS[sock]
+    buffer += data
+    sessions = MUX_SESSIONS[sock]
+    for session, kind, payload in MuxClient.unpack_frames(buffer):
+        if kind == MuxClient._OPEN:
+            sessions[session] = payload.decode(errors='replace')
+            broadcast(server_socket, sock, "%s entered our chat session\n" % sessions[session], session, CONTROL)
+        elif kind == MuxClient._CLOSE:
+            if session in sessions:
+                username = sessions.pop(session)
+                broadcast(server_socket, sock, "%s is offline\n" % username, session, CONTROL)
+        elif kind == MuxClient._DATA and session in sessions:
+            chat_message(server_socket, sock, payload.decode(errors='replace'), session)
+
+# a chat message from a client: answer it if it is a search command,
+# otherwise index it and relay it to everyone else
+def chat_message (server_socket, sock, message, session=None):
+    command = SEARCH_COMMAND.match(message)
+    if command and (not command.group(1) or command.group(2) and int(command.group(2)) < 1):
+        send_to(server_socket, sock, SEARCH_USAGE, session, CONTROL)
+    elif command:
+        query, page = command.group(1), int(command.group(2) or 1)
+        total, results = SEARCH_INDEX.search(query, page, SEARCH_PAGE_SIZE)
+        pages = max(1, -(-total // SEARCH_PAGE_SIZE))
+        reply = "Search '%s': %d results, page %d of %d\n" % (query, total, page, pages)
+        reply += ''.join("[#%d] %s\n" % (msg_id, text.rstrip('\n')) for msg_id, text in results)
+        send_to(server_socket, sock, reply, session, BULK)
+    else:
+        SEARCH_INDEX.add(message)
+        broadcast(server_socket, sock, message, session)
+
+# forget a connection, and every session it was carrying
+def remove_socket (server_socket, sock):
+    sock.close()
+    if sock in SOCKET_LIST:
+        SOCKET_LIST.remove(sock)
+    NEW_SOCKETS.pop(sock, None)
+    MUX_BUFFERS.pop(sock, None)
+    OUTBOX.pop(sock, None)
+    sessions = MUX_SESSIONS.pop(sock, {})
+    for session, username in sessions.items():
+        broadcast(server_socket, sock, "%s is offline\n" % username, session, CONTROL)
+
+# data waiting to be written to one chat connection, in priority classes;
+# whole messages are taken from the classes by weighted round robin
+# (deficit round robin), so a client flooded with bulk data still gets
+# control and interactive messages promptly
+class OutboundQueue:
+    def __init__(self):
+        self.queues = (deque(), deque(), deque())  # messages, by priority class
+        self.deficit = [0, 0, 0]  # bytes each class may still write this round
+        self.turn = BULK  # class being served; the first round starts at CONTROL
+        self.out = bytearray()  # messages chosen for writing, in order
+        self.size = 0  # bytes queued, including out
+
+    def pending(self):
+        return self.size > 0
+
+    def put(self, data, priority):
+        self.queues[priority].append(data)
+        self.size += len(data)
+
+    # choose messages, up to limit bytes (or one message larger than
+    # that), to write next
+    def fill(self, limit):
+        while len(self.out) < self.size:
+            queue = self.queues[self.turn]
+            if queue and self.deficit[self.turn] >= len(queue[0]):
+                if self.out and len(self.out) + len(queue[0]) > limit:
+                    break
+                self.deficit[self.turn] -= len(queue[0])
+                self.out += queue.popleft()
+                continue
+            if self.out:
+                break  # the next class's turn starts once this is written
+            if not queue:
+                self.deficit[self.turn] = 0
+            self.turn = (self.turn + 1) % len(self.queues)
+            if self.queues[self.turn]:
+                self.deficit[self.turn] += QUANTUM * WEIGHTS[self.turn]
+
+    # write up to SEND_BUDGET bytes, choosing messages only as the socket
+    # takes them, so a message queued later can still go ahead of bulk
+    # data not yet chosen; partly written messages stay at the front of
+    # out, so messages are never interleaved
+    def write(self, sock):
+        written = 0
+        while written < SEND_BUDGET and self.pending():
+            if not self.out:
+                self.fill(SEND_CHUNK)
+            sent = sock.send(self.out)
+            del self.out[:sent]
+            self.size -= sent
+            written += sent
+            if self.out:
+                break  # the socket is full
+
+# write waiting data to a chat connection
+def flush_outbox (server_socket, sock):
+    try :
+        OUTBOX[sock].write(sock)
+    except BlockingIOError:
+        pass
+    except OSError:
+        remove_socket(server_socket, sock)
+
+# queue data for a chat connection; it is written when the socket is ready
+def enqueue (server_socket, sock, data, priority):
+    outbox = OUTBOX.get(sock)
+    if outbox is None:
+        return
+    outbox.put(data, priority)
+    if outbox.size > MAX_OUTBOX:
+        # this client is not keeping up - drop it rather than buffer forever
+        print("Client too slow, disconnecting")
+        remove_socket(server_socket, sock)
+
+# send a message to one client (one session, if sock is multiplexed)
+def send_to (server_socket, sock, message, session=None, priority=INTERACTIVE):
+    data = message.encode()
+    if sock in MUX_SESSIONS:
+        data = MuxClient.pack_frame(session, MuxClient._DATA, data)
+    enqueue(server_socket, sock, data, priority)
+
 # broadcast chat messages to all connected clients
-def broadcast (server_socket, sock, message):
-    for socket in SOCKET_LIST:
-        # send the message only to peer
-        if socket != server_socket and socket != sock :
-            try :
-                socket.send(message.encode())
-            except :
-                # broken socket connection
-                socket.close()
-                # broken socket, remove it
-                if socket in SOCKET_LIST:
-                    SOCKET_LIST.remove(socket)
+# session is the id of the sending session when sock is multiplexed
+def broadcast (server_socket, sock, message, session=None, priority=INTERACTIVE):
+    data = message.encode()
+    for socket in list(SOCKET_LIST):
+        if socket == server_socket:
+            continue
+        if socket in MUX_SESSIONS:
+            # one frame for all of the connection's sessions, which the
+            # client copies to each of them, but the sending session
+            if socket == sock:
+                excluded = session
+            else:
+                excluded = MuxClient._NO_SESSION
+            out = MuxClient.pack_frame(excluded, MuxClient._BROADCAST, data)
+        elif socket != sock:
+            # send the message only to peer
+            out = data
+        else:
+            continue
+        enqueue(server_socket, socket, out, priority)
  
 if __name__ == "__main__":
+    # stop cleanly on SIGTERM too, so the spool directory is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    # optional argument: file to capture inbound traffic to
+    if len(sys.argv) > 1:
+        sys.exit(chat_server(capture=sys.argv[1]))
     sys.exit(chat_server())
 
 
@@ -4,176 +4,378 @@
 #####################################################################################
 #                                   IMPORTS                                         #
 #####################################################################################
-#import the turtle module
-#import the Client class from the turtle_chat_client module
-#Finally, from the turtle_chat_widgets module, import two classes: Button and TextInput
+import sys
+import select
+import threading
+import tkinter
+import textwrap
+import turtle
+from turtle_chat_client import Client
+from turtle_chat_widgets import Button, TextInput
+from turtle_chat_render import TurtleRenderer
 #####################################################################################
 #####################################################################################
 
 #####################################################################################
 #                                   TextBox                                         #
 #####################################################################################
-#Make a class called TextBox, which will be a subclass of TextInput.
-#Because TextInput is an abstract class, you must implement its abstract
-#methods.  There are two:
-#
-#draw_box
-#write_msg
-#
-#Hints:
-#1. in draw_box, you will draw (or stamp) the space on which the user's input
-#will appear.
-#
-#2. All TextInput objects have an internal turtle called writer (for example, self will
-#   have something called writer).  You can write new text with it using code like
-#
-#   self.writer.write(a_string_variable)
-#
-#   and you can erase that text using
-#
-#   self.writer.clear()
-#
-#3. If you want to make a newline character (for example, go to the next line), just add
-#   \r to your string.  Test it out at the Python shell for practice
+#TextBox is the concrete TextInput used by the View: a rectangle with the
+#message being typed written inside of it, wrapped every letters_per_line
+#letters.
 #####################################################################################
 #####################################################################################
+class TextBox(TextInput):
+    def draw_box(self):
+        '''
+        Draw the rectangle surrounding the text field.
+        '''
+        pen=self.renderer.new_pen()
+        pen.hideturtle()
+        pen.speed(0)
+        pen.penup()
+        pen.goto(self.pos[0]-self.width/2,self.pos[1]-self.height/2)
+        pen.pendown()
+        pen.setheading(0)
+        for side in (self.width,self.height,self.width,self.height):
+            pen.forward(side)
+            pen.left(90)
+        pen.penup()
+
+    def write_msg(self):
+        '''
+        Draw the lines of the message that changed since the last
+        call - wrapping every letters_per_line letters is done by
+        the layout as the message is typed.
+        '''
+        self.write_lines()
 
 #####################################################################################
 #                                  SendButton                                       #
 #####################################################################################
-#Make a class called SendButton, which will be a subclass of Button.
-#Button is an abstract class with one abstract method: fun.
-#fun gets called whenever the button is clicked.  Its jobs will be to
-#
-# 1. send a message to the other chat participant - to do this,
-#    you will need to call the send method of your Client instance
-# 2. update the messages that you see on the screen
-#
-#HINT: You may want to override the __init__ method so that it takes one additional
-#      input: view.  This will be an instance of the View class you will make next
-#      That class will have methods inside of it to help
-#      you send messages and update message displays.
+#SendButton is the concrete Button used by the View.  Clicking it (or pressing
+#Return) asks the view to send the message in the textbox.
 #####################################################################################
 #####################################################################################
+class SendButton(Button):
+    def __init__(self,view,my_turtle=None,shape=None,pos=(0,-100),renderer=None):
+        '''
+        :param view: the View instance whose message gets sent on click.
+        Other parameters as in Button.
+        '''
+        self.view=view
+        Button.__init__(self,my_turtle=my_turtle,shape=shape,pos=pos,renderer=renderer)
+
+    def fun(self,x=None,y=None):
+        self.view.send_msg()
+
+
+##################################################################
+#                          Scrollback                            #
+##################################################################
+#Scrollback keeps the whole chat history and draws the part of it
+#that fits on screen.  Every message is wrapped into lines once,
+#when it arrives; the lines are kept in one flat list, so finding
+#the lines to show costs the same however long the history is.
+#Only rows whose text changed get redrawn.
+##################################################################
+##################################################################
+class Scrollback:
+    def __init__(self,rows=10,pos=(0,0),row_height=20,letters_per_line=35,renderer=None):
+        '''
+        :param rows: integer, number of lines visible at once.
+        :param pos: tuple, (x,y) - location of the bottom row.
+        :param row_height: integer, vertical distance between rows (pixels).
+        :param letters_per_line: integer, width messages are wrapped to.
+        :param renderer: rendering backend, from turtle_chat_render.
+                         Default=None - draw with the turtle module.
+        '''
+        if renderer is None:
+            renderer=TurtleRenderer()
+        self.renderer=renderer
+        self.rows=rows
+        self.letters_per_line=letters_per_line
+        self.lines=[] #Wrapped lines of every message, oldest first
+        self.offset=0 #Lines scrolled back from the newest; 0 follows new messages
+        self.shown=[None]*rows #Text currently drawn in each row
+        self.repaint_pending=False
+        self.pens=[]
+        for i in range(rows):
+            pen=self.renderer.new_pen()
+            pen.hideturtle()
+            pen.penup()
+            pen.goto(pos[0],pos[1]+row_height*i)
+            self.pens.append(pen)
+
+    def wrap(self,msg):
+        '''
+        :param msg: message string; \\r or \\n start a new line.
+        :return: list of lines no longer than letters_per_line.
+        '''
+        lines=[]
+        for part in msg.replace('\r','\n').split('\n'):
+            lines.extend(textwrap.wrap(part,self.letters_per_line) or [''])
+        return lines
+
+    def add(self,msg):
+        '''
+        Append a message to the history and schedule a repaint.  If the user
+        has scrolled back, the rows they are reading stay where they are.
+
+        :param msg: message string.
+        '''
+        new_lines=self.wrap(msg)
+        self.lines.extend(new_lines)
+        if self.offset!=0:
+            self.offset+=len(new_lines)
+        self.request_repaint()
+
+    def scroll(self,n):
+        '''
+        :param n: integer, lines to move back in history (negative moves
+                  towards the newest message).
+        '''
+        offset=max(0,min(self.offset+n,len(self.lines)-self.rows))
+        if offset!=self.offset:
+            self.offset=offset
+            self.request_repaint()
+
+    def visible_lines(self):
+        '''
+        :return: list of the lines in the viewport, bottom row first.
+        '''
+        end=len(self.lines)-self.offset
+        start=max(0,end-self.rows)
+        return self.lines[start:end][::-1]
+
+    def request_repaint(self):
+        '''
+        Ask for the viewport to be redrawn once the event loop is idle.  Any
+        number of calls before then collapse into a single repaint.
+        '''
+        if not self.repaint_pending:
+            self.repaint_pending=True
+            self.renderer.after_idle(self.repaint)
+
+    def repaint(self):
+        '''
+        Redraw only the rows whose text changed, in a single screen update.
+        '''
+        self.repaint_pending=False
+        visible=self.visible_lines()
+        tracing=self.renderer.tracer()
+        self.renderer.tracer(0)
+        for i,pen in enumerate(self.pens):
+            if i<len(visible):
+                text=visible[i]
+            else:
+                text=None
+            if text!=self.shown[i]:
+                pen.clear()
+                if text is not None:
+                    pen.write(text)
+                self.shown[i]=text
+        self.renderer.update()
+        self.renderer.tracer(tracing)
 
 
 ##################################################################
 #                             View                               #
 ##################################################################
-#Make a new class called View.  It does not need to have a parent
-#class mentioned explicitly.
-#
-#Read the comments below for hints and directions.
+#View puts the chat on the screen: the log of recent messages, the
+#textbox the user types in and the send button.
 ##################################################################
 ##################################################################
 class View:
-    _MSG_LOG_LENGTH=5 #Number of messages to retain in view
     _SCREEN_WIDTH=300
     _SCREEN_HEIGHT=600
-    _LINE_SPACING=round(_SCREEN_HEIGHT/2/(_MSG_LOG_LENGTH+1))
+    _ROW_HEIGHT=20 #Height of one line of the message log, pixels
+    _LOG_ROWS=round(_SCREEN_HEIGHT/2/_ROW_HEIGHT)-3 #Lines of history visible at once, above the textbox
+    _LETTERS_PER_LINE=35 #Width messages in the log are wrapped to
+    _SCROLL_PAGE=_LOG_ROWS-1 #Lines moved by Page Up / Page Down
+    _FLUSH_WAIT=50 #Time between attempts to write queued outgoing data, ms
+    _WAKE_EVENT='<<ChatMessage>>' #Virtual event used by the reader thread
 
-    def __init__(self,username='Me',partner_name='Partner'):
+    def __init__(self,username='Me',partner_name='Partner',client=None,renderer=None):
         '''
         :param username: the name of this chat user
         :param partner_name: the name of the user you are chatting with
+        :param client: object with the methods of Client used to talk to
+                       the server.  Default=None - connect a new Client.
+        :param renderer: rendering backend, from turtle_chat_render.
+                         Default=None - draw with the turtle module.
+        '''
+        self.username=username
+        self.partner_name=partner_name
+        self.flush_scheduled=False
+
+        #Connect to the server in the background while the widgets are built.
+        self.my_client=client
+        if client is None:
+            self._connect_error=None
+            connecting=threading.Thread(target=self._connect)
+            connecting.start()
+
+        if renderer is None:
+            renderer=TurtleRenderer()
+        self.renderer=renderer
+        self.renderer.setup(View._SCREEN_WIDTH,View._SCREEN_HEIGHT)
+
+        #Build the whole layout with animation off, then draw it in one frame.
+        tracing=self.renderer.tracer()
+        self.renderer.tracer(0)
+
+        self.textbox=TextBox(renderer=self.renderer)
+        #Typing or pasting stops once the textbox is full.
+        self.textbox.max_msg_length=self.textbox.capacity()
+
+        #All of the messages, and the part of them shown on screen, in
+        #the rows above the textbox.
+        self.scrollback=Scrollback(rows=View._LOG_ROWS,
+                                   pos=(-View._SCREEN_WIDTH/2+10,
+                                        self.textbox.pos[1]+self.textbox.height/2+View._ROW_HEIGHT/2),
+                                   row_height=View._ROW_HEIGHT,
+                                   letters_per_line=View._LETTERS_PER_LINE,
+                                   renderer=self.renderer)
+        self.send_btn=SendButton(self,renderer=self.renderer)
+
+        self.setup_listeners()
+
+        self.renderer.update()
+        self.renderer.tracer(tracing)
+
+        if client is None:
+            connecting.join()
+            if self._connect_error is not None:
+                raise self._connect_error
+
+    def _connect(self):
         '''
-        ###
-        #Store the username and partner_name into the instance.
-        ###
-
-        ###
-        #Make a new Client object and store it in this instance of View
-        #(for example, self).  The name of the instance should be my_client
-        ###
-
-        ###
-        #Set screen dimensions using turtle.setup
-        #You can get help on this function, as with other turtle functions,
-        #by typing
-        #
-        #   import turtle
-        #   help(turtle.setup)
-        #
-        #at the Python shell.
-        ###
-
-        ###
-        #This list will store all of the messages.
-        #You can add strings to the front of the list using
-        #   self.msg_queue.insert(0,a_msg_string)
-        #or at the end of the list using
-        #   self.msg_queue.append(a_msg_string)
-        self.msg_queue=[]
-        ###
-
-        ###
-        #Create one turtle object for each message to display.
-        #You can use the clear() and write() methods to erase
-        #and write messages for each
-        ###
-
-        ###
-        #Create a TextBox instance and a SendButton instance and
-        #Store them inside of this instance
-        ###
-
-        ###
-        #Call your setup_listeners() function, if you have one,
-        #and any other remaining setup functions you have invented.
-        ###
+        Connect a new Client; run on a background thread by __init__.
+        '''
+        try:
+            self.my_client=Client(self.username,self.partner_name)
+        except Exception as err:
+            self._connect_error=err
 
     def send_msg(self):
         '''
-        You should implement this method.  It should call the
-        send() method of the Client object stored in this View
-        instance.  It should also update the list of messages,
-        self.msg_queue, to include this message.  It should
-        clear the textbox text display (hint: use the clear_msg method).
-        It should call self.display_msg() to cause the message
-        display to be updated.
+        Send the message in the textbox, add it to the log of
+        messages, clear the textbox and update the message display.
         '''
-        pass
+        msg=self.get_msg()
+        self.my_client.send(msg)
+        self.scrollback.add(self.username+' says:\r'+msg)
+        self.textbox.clear_msg()
+        #Messages sent before the event loop comes round go out together.
+        if self.my_client.has_pending() and not self.flush_scheduled:
+            self.flush_scheduled=True
+            self.renderer.after_idle(self.flush_pending)
+
+    def flush_pending(self):
+        '''
+        Write queued outgoing data, trying again every _FLUSH_WAIT ms
+        while the socket cannot take all of it.  Runs only while there
+        is something queued.
+        '''
+        if self.my_client.flush(block=False) != 0:
+            self.renderer.ontimer(self.flush_pending,View._FLUSH_WAIT)
+        else:
+            self.flush_scheduled=False
 
     def get_msg(self):
         return self.textbox.get_msg()
 
-    
-
     def setup_listeners(self):
         '''
         Set up send button - additional listener, in addition to click,
-        so that return button will send a message.
-        To do this, you will use the turtle.onkeypress function.
-        The function that it will take is
-        self.send_btn.fun
-        where send_btn is the name of your button instance
+        so that return button will send a message.  The arrow keys,
+        Page Up / Page Down and the mouse wheel scroll through history.
+        '''
+        self.renderer.onkeypress(self.send_btn.fun,'Return')
+        self.renderer.onkeypress(lambda: self.scrollback.scroll(1),'Up')
+        self.renderer.onkeypress(lambda: self.scrollback.scroll(-1),'Down')
+        self.renderer.onkeypress(lambda: self.scrollback.scroll(View._SCROLL_PAGE),'Prior')
+        self.renderer.onkeypress(lambda: self.scrollback.scroll(-View._SCROLL_PAGE),'Next')
+        self.renderer.bind('<MouseWheel>',lambda event: self.scrollback.scroll(1 if event.delta>0 else -1))
+        self.renderer.bind('<Button-4>',lambda event: self.scrollback.scroll(1))
+        self.renderer.bind('<Button-5>',lambda event: self.scrollback.scroll(-1))
+        #No need to call listen() - the textbox already did.
 
-        Then, it can call turtle.listen()
+    def watch_client(self):
         '''
-        pass
+        Have Tk tell us when the client socket has data, so a message is
+        shown the moment it arrives and nothing runs while the chat is idle.
+
+        Where Tk can watch sockets (createfilehandler, Unix), the socket is
+        registered with the event loop directly.  Elsewhere a reader thread
+        waits on the socket and wakes the event loop with a virtual event;
+        all reading is still done on the main thread.  Needs a renderer
+        with a Tk window (the turtle backend).
+        '''
+        server=self.my_client.get_server()
+        root=self.renderer.root()
+        self._root=root
+        try:
+            root.tk.createfilehandler(server,tkinter.READABLE,self._socket_ready)
+            self._reader=None
+        except (AttributeError,RuntimeError):
+            self._consumed=threading.Event()
+            root.bind(View._WAKE_EVENT,self._wakeup)
+            self._reader=threading.Thread(target=self._wait_for_data,args=(server,),daemon=True)
+            self._reader.start()
+
+    def _socket_ready(self,file,mask):
+        self.deliver()
+
+    def _wakeup(self,event):
+        self.deliver()
+        self._consumed.set()
+
+    def _wait_for_data(self,server):
+        '''
+        Reader thread: wait until the socket is readable, wake the
+        event loop, then wait for the main thread to read it.
+        '''
+        while True:
+            self._consumed.clear()
+            select.select([server],[],[])
+            self._root.event_generate(View._WAKE_EVENT,when='tail')
+            self._consumed.wait()
+
+    def deliver(self):
+        '''
+        Read whatever the client has received and display it.
+        '''
+        msg_in=self.my_client.receive()
+        if msg_in is None:
+            return
+        if msg_in==Client._END_MSG:
+            if self._reader is None:
+                self._root.tk.deletefilehandler(self.my_client.get_server())
+            print('End message received')
+            sys.exit()
+        else:
+            self.msg_received(msg_in)
 
     def msg_received(self,msg):
         '''
         This method is called when a new message is received.
-        It should update the log (queue) of messages, and cause
-        the view of the messages to be updated in the display.
+        It adds the message to the scrollback, which updates
+        the display.
 
         :param msg: a string containing the message received
                     - this should be displayed on the screen
         '''
         print(msg) #Debug - print message
         show_this_msg=self.partner_name+' says:\r'+ msg
-        #Add the message to the queue either using insert (to put at the beginning)
-        #or append (to put at the end).
-        #
-        #Then, call the display_msg method to update the display
+        self.scrollback.add(show_this_msg)
 
     def display_msg(self):
         '''
-        This method should update the messages displayed in the screen.
-        You can get the messages you want from self.msg_queue
+        Update the messages displayed in the screen.  Messages arriving
+        in a burst are drawn together in one repaint.
         '''
-        pass
+        self.scrollback.request_repaint()
 
     def get_client(self):
         return self.my_client
@@ -188,16 +390,5 @@ class View:
 ###########################################################
 if __name__ == '__main__':
     my_view=View()
-    _WAIT_TIME=200 #Time between check for new message, ms
-    def check() :
-        #msg_in=my_view.my_client.receive()
-        msg_in=my_view.get_client().receive()
-        if not(msg_in is None):
-            if msg_in==Client._END_MSG:
-                print('End message received')
-                sys.exit()
-            else:
-                my_view.msg_received(msg_in)
-        turtle.ontimer(check,_WAIT_TIME) #Check recursively
-    check()
+    my_view.watch_client() #Messages are shown as soon as they arrive
     turtle.mainloop()
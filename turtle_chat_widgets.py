@@ -1,5 +1,6 @@
-import turtle
+import string
 from abc import ABCMeta,abstractmethod
+from turtle_chat_render import TurtleRenderer
 
 class Button(metaclass=ABCMeta):
     '''
@@ -7,7 +8,7 @@ class Button(metaclass=ABCMeta):
 
     The abstract method, fun, is called when the button is clicked on.
     '''
-    def __init__(self,my_turtle=None,shape=None,pos=(0,0)):
+    def __init__(self,my_turtle=None,shape=None,pos=(0,0),renderer=None):
         '''
         Initialize Button object.  The button will be given an onclick
         listener that triggers the implementation of the abstract method, fun.
@@ -21,11 +22,15 @@ class Button(metaclass=ABCMeta):
                     turtle.shape('square'); turtle.shapesize(2,10)
         :param pos: tuple input, (x,y), specifying the location of the
                     turtle object.
+        :param renderer: rendering backend, from turtle_chat_render.
+                    Default=None - draw with the turtle module.
         '''
-        print('test')
+        if renderer is None :
+            renderer=TurtleRenderer()
+        self.renderer=renderer
         if my_turtle is None :
             #If no turtle given, create new one
-            self.turtle=turtle.clone()
+            self.turtle=self.renderer.new_pen()
         else:
             self.turtle=my_turtle
 
@@ -38,11 +43,10 @@ class Button(metaclass=ABCMeta):
             self.turtle.shape('square')
             self.turtle.shapesize(2,10)
         else:
-            turtle.addshape(shape)
+            self.renderer.addshape(shape)
             self.turtle.shape(shape)
         self.turtle.showturtle()
         self.turtle.onclick(self.fun) #Link listener to button function
-        turtle.listen() #Start listener
 
 
     @abstractmethod
@@ -58,12 +62,89 @@ class Button(metaclass=ABCMeta):
         '''
         pass
 
+class TextLayout:
+    '''
+    Keeps a message wrapped into lines of letters_per_line letters.
+
+    Every line but the last is full, so appending or deleting text at the
+    end only touches the last line (and any lines added or removed after
+    it).  The indices of changed lines are collected in dirty, so the
+    caller can redraw just those.
+    '''
+    def __init__(self,letters_per_line=40):
+        '''
+        :param letters_per_line: integer, number of letters per line.
+        '''
+        self.letters_per_line=letters_per_line
+        self.lines=[] #Wrapped lines of the message, first line first
+        self.dirty=set() #Indices of lines changed since take_dirty was called
+
+    def append(self,text):
+        '''
+        :param text: string added to the end of the message.
+        '''
+        if len(text) == 0 :
+            return
+        tail=''
+        if len(self.lines) != 0 and len(self.lines[-1]) < self.letters_per_line :
+            tail=self.lines.pop()
+        start=len(self.lines)
+        text=tail+text
+        for i in range(0,len(text),self.letters_per_line) :
+            self.lines.append(text[i:i+self.letters_per_line])
+        self.dirty.update(range(start,len(self.lines)))
+
+    def backspace(self,n=1):
+        '''
+        :param n: integer, number of letters removed from the end of the message.
+        '''
+        while n > 0 and len(self.lines) != 0 :
+            last=self.lines[-1]
+            if len(last) <= n :
+                n-=len(last)
+                self.lines.pop()
+                self.dirty.add(len(self.lines))
+            else :
+                self.lines[-1]=last[:-n]
+                self.dirty.add(len(self.lines)-1)
+                n=0
+
+    def reset(self,text=''):
+        '''
+        :param text: string replacing the whole message.
+        '''
+        self.dirty.update(range(len(self.lines)))
+        self.lines=[]
+        self.append(text)
+
+    def take_dirty(self):
+        '''
+        :return: sorted list of indices of lines changed since the last
+                 call.  Indices past the end are lines that were removed.
+        '''
+        dirty=sorted(self.dirty)
+        self.dirty=set()
+        return dirty
+
 class TextInput(metaclass=ABCMeta):
     '''
     This class sets up a textbox to take live text input from
     the user via keyboard listeners.
     '''
-    def __init__(self, width=200, height=100, pos=(0,0), background_gif=None, letters_per_line=40):
+    #Tk key name -> character typed.  To find text key names, you can refer to
+    #http://www.tcl.tk/man/tcl8.4/TkCmd/keysyms.htm
+    _KEYMAP=dict([(c,c) for c in string.ascii_letters+string.digits]+[
+        ('space',' '), ('comma',','), ('period','.'), ('exclam','!'), #Yes, exclam
+        ('colon',':'), ('dollar','$'), ('quotedbl','"'), ('quoteright',"'"),
+        ('quoteleft','`'), ('parenleft','('), ('parenright',')'), ('minus','-'),
+        ('slash','/'), ('plus','+'), ('ampersand','&'), ('numbersign','#'),
+        ('asterisk','*'), ('percent','%'), ('at','@'), ('question','?'),
+        ('equal','='), ('less','<'), ('greater','>'), ('underscore','_'),
+        ('backslash','\\'), ('bracketright',']'), ('bracketleft','[')])
+    _LINE_HEIGHT=15 #Vertical distance between lines of text, pixels
+    _PASTE_TRANSLATION=str.maketrans('\r\n\t','   ') #Pasted line breaks become spaces
+
+    def __init__(self, width=200, height=100, pos=(0,0), background_gif=None, letters_per_line=40, renderer=None, debug=False, max_msg_length=None):
         '''
         Initialize TextInput object.
 
@@ -76,14 +157,30 @@ class TextInput(metaclass=ABCMeta):
                                - can be used in draw_box, though not required.
                                Default=None.
         :param letters_per_line: integer, number of letters per line.
+        :param renderer: rendering backend, from turtle_chat_render.
+                         Default=None - draw with the turtle module.
+        :param debug: boolean, print the message after every redraw.
+                      Default=False.
+        :param max_msg_length: integer, most letters the message may hold;
+                               further typing or pasting is dropped.
+                               Default=None (no limit).
         '''
+        if renderer is None :
+            renderer=TurtleRenderer()
+        self.renderer=renderer
+        self.debug=debug
+        self.redraw_pending=False
         self.width=width
         self.height=height
         self.letters_per_line=letters_per_line
+        self.max_msg_length=max_msg_length
         self.background_gif=background_gif
-        self.new_msg='' #This string stores text stream going into text box.
+        self._buffer=[] #Characters of the text stream going into text box.
+        self._text='' #The same text joined into a string, or None if stale.
+        self.layout=TextLayout(letters_per_line) #The same text wrapped into lines.
+        self.line_pens=[] #One turtle per line of text, made when first needed
         self.pos=pos
-        self.writer=turtle.clone()
+        self.writer=self.renderer.new_pen()
         self.writer.hideturtle()
         self.writer.penup()
         #Move writer to location where text starts.
@@ -111,13 +208,58 @@ class TextInput(metaclass=ABCMeta):
         concrete classes.
 
         Opportunity, also, to clean strings - add in newlines,
-        '\r', for example, when needed, etc.
+        '\r', for example, when needed, etc.  Implementations
+        can call write_lines to draw the wrapped lines in layout,
+        redrawing only the ones that changed.
 
         Side effect method - no inputs or outputs, but
         new_msg may be changed.
         '''
         pass
 
+    def capacity(self):
+        '''
+        :return: integer, most letters that fit inside the box: whole
+                 lines of letters_per_line, _LINE_HEIGHT pixels apart.
+        '''
+        return self.letters_per_line*(self.height//TextInput._LINE_HEIGHT)
+
+    def write_lines(self):
+        '''
+        Redraw the lines of the message that changed since the last
+        call.  Lines run down from the top of the box.
+        '''
+        for i in self.layout.take_dirty() :
+            while len(self.line_pens) <= i :
+                pen=self.renderer.new_pen()
+                pen.hideturtle()
+                pen.speed(0) #No animated move: this happens while typing
+                pen.penup()
+                pen.goto(-self.width/2+10+self.pos[0],
+                         self.pos[1]+self.height/2-TextInput._LINE_HEIGHT*(len(self.line_pens)+1))
+                self.line_pens.append(pen)
+            pen=self.line_pens[i]
+            pen.clear()
+            if i < len(self.layout.lines) :
+                pen.write(self.layout.lines[i])
+
+    @property
+    def new_msg(self):
+        '''
+        The text typed so far, as a string.  Characters are kept in a list
+        so typing appends in constant time; the string is built only when
+        it is read after a change.
+        '''
+        if self._text is None :
+            self._text=''.join(self._buffer)
+        return self._text
+
+    @new_msg.setter
+    def new_msg(self,msg):
+        self._buffer=list(msg)
+        self._text=msg
+        self.layout.reset(msg)
+
     def clear_msg(self):
         '''
         Erase message in new_msg stream and update display.
@@ -133,477 +275,87 @@ class TextInput(metaclass=ABCMeta):
 
     def setup_listeners(self):
         '''
-        Set up listeners for all of the buttons.
-        '''
-
-        #To find text key names, you can refer to
-        #http://www.tcl.tk/man/tcl8.4/TkCmd/keysyms.htm
-        #Numbers
-        turtle.onkeypress( self.add_0, '0' )
-        turtle.onkeypress( self.add_1, '1' )
-        turtle.onkeypress( self.add_2, '2' )
-        turtle.onkeypress( self.add_3, '3' )
-        turtle.onkeypress( self.add_4, '4' )
-        turtle.onkeypress( self.add_5, '5' )
-        turtle.onkeypress( self.add_6, '6' )
-        turtle.onkeypress( self.add_7, '7' )
-        turtle.onkeypress( self.add_8, '8' )
-        turtle.onkeypress( self.add_9, '9' )
-
-        #Punctuation, etc.
-        turtle.onkeypress( self.add_comma, 'comma' )
-        turtle.onkeypress( self.add_period, 'period' )
-        turtle.onkeypress( self.add_exclaim, 'exclam' ) #Yes, exclam
-        turtle.onkeypress( self.add_colon, 'colon' )
-        turtle.onkeypress( self.add_dollar, 'dollar' )
-        turtle.onkeypress( self.add_dblquote,'quotedbl')
-        turtle.onkeypress( self.add_quoteright,'quoteright')
-        turtle.onkeypress( self.add_quoteleft,'quoteleft')
-        turtle.onkeypress( self.add_parenleft,'parenleft')
-        turtle.onkeypress( self.add_parenright,'parenright')
-        turtle.onkeypress( self.add_minus,'minus')
-        turtle.onkeypress( self.add_slash,'slash')
-        turtle.onkeypress( self.add_plus,'plus')
-        turtle.onkeypress( self.add_ampersand,'ampersand')
-        turtle.onkeypress( self.add_pound,'numbersign')
-        turtle.onkeypress( self.add_asterisk,'asterisk')
-        turtle.onkeypress( self.add_percent, 'percent')
-        turtle.onkeypress( self.add_space, 'space' )
-        turtle.onkeypress( self.backspace, 'BackSpace' )
-        #turtle.onkeypress( self.shift, 'Shift_L' )
-        #turtle.onkeypress( self.shift, 'Shift_R' )
-        #turtle.onkeypress( self.caps, 'Caps_Lock' )
-        #turtle.onkeyrelease( self.shift_release, 'Shift_L' )
-        #turtle.onkeyrelease( self.shift_release, 'Shift_R' )
-        turtle.onkeypress( self.add_at, 'at')
-        turtle.onkeypress( self.add_question,'question')
-        turtle.onkeypress( self.add_equal,'equal')
-        turtle.onkeypress( self.add_less,'less')
-        turtle.onkeypress( self.add_greater,'greater')
-        turtle.onkeypress( self.add_underscore,'underscore')
-        turtle.onkeypress( self.add_backslash,'backslash')
-        turtle.onkeypress( self.add_brackright,'bracketright')
-        turtle.onkeypress( self.add_brackleft,'bracketleft')
-
-        #Lower-case letters
-        turtle.onkeypress( self.add_a, 'a' )
-        turtle.onkeypress( self.add_b, 'b' )
-        turtle.onkeypress( self.add_c, 'c' )
-        turtle.onkeypress( self.add_d, 'd' )
-        turtle.onkeypress( self.add_e, 'e' )
-        turtle.onkeypress( self.add_f, 'f' )
-        turtle.onkeypress( self.add_g, 'g' )
-        turtle.onkeypress( self.add_h, 'h' )
-        turtle.onkeypress( self.add_i, 'i' )
-        turtle.onkeypress( self.add_j, 'j' )
-        turtle.onkeypress( self.add_k, 'k' )
-        turtle.onkeypress( self.add_l, 'l' )
-        turtle.onkeypress( self.add_m, 'm' )
-        turtle.onkeypress( self.add_n, 'n' )
-        turtle.onkeypress( self.add_o, 'o' )
-        turtle.onkeypress( self.add_p, 'p' )
-        turtle.onkeypress( self.add_q, 'q' )
-        turtle.onkeypress( self.add_r, 'r' )
-        turtle.onkeypress( self.add_s, 's' )
-        turtle.onkeypress( self.add_t, 't' )
-        turtle.onkeypress( self.add_u, 'u' )
-        turtle.onkeypress( self.add_v, 'v' )
-        turtle.onkeypress( self.add_w, 'w' )
-        turtle.onkeypress( self.add_x, 'x' )
-        turtle.onkeypress( self.add_y, 'y' )
-        turtle.onkeypress( self.add_z, 'z' )
-
-        #Upper-case letters
-        turtle.onkeypress( self.add_A, 'A' )
-        turtle.onkeypress( self.add_B, 'B' )
-        turtle.onkeypress( self.add_C, 'C' )
-        turtle.onkeypress( self.add_D, 'D' )
-        turtle.onkeypress( self.add_E, 'E' )
-        turtle.onkeypress( self.add_F, 'F' )
-        turtle.onkeypress( self.add_G, 'G' )
-        turtle.onkeypress( self.add_H, 'H' )
-        turtle.onkeypress( self.add_I, 'I' )
-        turtle.onkeypress( self.add_J, 'J' )
-        turtle.onkeypress( self.add_K, 'K' )
-        turtle.onkeypress( self.add_L, 'L' )
-        turtle.onkeypress( self.add_M, 'M' )
-        turtle.onkeypress( self.add_N, 'N' )
-        turtle.onkeypress( self.add_O, 'O' )
-        turtle.onkeypress( self.add_P, 'P' )
-        turtle.onkeypress( self.add_Q, 'Q' )
-        turtle.onkeypress( self.add_R, 'R' )
-        turtle.onkeypress( self.add_S, 'S' )
-        turtle.onkeypress( self.add_T, 'T' )
-        turtle.onkeypress( self.add_U, 'U' )
-        turtle.onkeypress( self.add_V, 'V' )
-        turtle.onkeypress( self.add_W, 'W' )
-        turtle.onkeypress( self.add_X, 'X' )
-        turtle.onkeypress( self.add_Y, 'Y' )
-        turtle.onkeypress( self.add_Z, 'Z' )
+        Set up listeners for typing, backspace and paste (Control-v
+        or Shift-Insert).  All of the keys in _KEYMAP share a single
+        binding; Tk calls the more specific bindings (BackSpace,
+        paste, and any a view adds, such as Return) instead of it.
+        '''
+        self.renderer.bind( '<KeyPress>', self.key_pressed )
+        self.renderer.onkeypress( self.backspace, 'BackSpace' )
+        self.renderer.bind( '<Control-v>', self.paste )
+        self.renderer.bind( '<Shift-Insert>', self.paste )
 
         #Start listeners
-        turtle.listen()
+        self.renderer.listen()
 
-    #All methods adding (or subtracting, in case of backspace)
-    #letters from message.
-    def add_space(self):
-        self.new_msg+=' '
-        self.write_msg()
-        print(self.new_msg)
-    def add_a(self):
-        self.new_msg+='a'
-        self.write_msg()
-        print(self.new_msg)    
-    def add_A(self):
-        self.new_msg+='A'
-        self.write_msg()
-        print(self.new_msg)
-    def add_b(self):
-        self.new_msg+='b'
-        self.write_msg()
-        print(self.new_msg)
-    def add_B(self) :
-        self.new_msg+='B'
-        self.write_msg()
-        print(self.new_msg)
-    def add_c(self):
-        self.new_msg+='c'
-        self.write_msg()
-        print(self.new_msg)
-    def add_C(self):
-        self.new_msg+='C'
-        self.write_msg()
-        print(self.new_msg)
-    def add_d(self):
-        self.new_msg+='d'
-        self.write_msg()
-        print(self.new_msg)
-    def add_D(self):
-        self.new_msg+='D'
-        self.write_msg()
-        print(self.new_msg)
-    def add_e(self):
-        self.new_msg+='e'
-        self.write_msg()
-        print(self.new_msg)
-    def add_E(self):
-        self.new_msg+='E'
-        self.write_msg()
-        print(self.new_msg)
-    def add_f(self):
-        self.new_msg+='f'
-        self.write_msg()
-        print(self.new_msg)
-    def add_F(self):
-        self.new_msg+='F'
-        self.write_msg()
-        print(self.new_msg)
-    def add_g(self):
-        self.new_msg+='g'
-        self.write_msg()
-        print(self.new_msg)
-    def add_G(self):
-        self.new_msg+='G'
-        self.write_msg()
-        print(self.new_msg)
-    def add_h(self):
-        self.new_msg+='h'
-        self.write_msg()
-        print(self.new_msg)
-    def add_H(self):
-        self.new_msg+='H'
-        self.write_msg()
-        print(self.new_msg)
-    def add_i(self):
-        self.new_msg+='i'
-        self.write_msg()
-        print(self.new_msg)
-    def add_I(self):
-        self.new_msg+='I'
-        self.write_msg()
-        print(self.new_msg)
-    def add_j(self):
-        self.new_msg+='j'
-        self.write_msg()
-        print(self.new_msg)
-    def add_J(self):
-        self.new_msg+='J'
-        self.write_msg()
-        print(self.new_msg)
-    def add_k(self):
-        self.new_msg+='k'
-        self.write_msg()
-        print(self.new_msg)
-    def add_K(self):
-        self.new_msg+='K'
-        self.write_msg()
-        print(self.new_msg)
-    def add_l(self):
-        self.new_msg+='l'
-        self.write_msg()
-        print(self.new_msg)
-    def add_L(self):
-        self.new_msg+='L'
-        self.write_msg()
-        print(self.new_msg)
-    def add_m(self):
-        self.new_msg+='m'
-        self.write_msg()
-        print(self.new_msg)
-    def add_M(self):
-        self.new_msg+='M'
-        self.write_msg()
-        print(self.new_msg)
-    def add_n(self):
-        self.new_msg+='n'
-        self.write_msg()
-        print(self.new_msg)
-    def add_N(self):
-        self.new_msg+='N'
-        self.write_msg()
-        print(self.new_msg)
-    def add_o(self):
-        self.new_msg+='o'
-        self.write_msg()
-        print(self.new_msg)
-    def add_O(self):
-        self.new_msg+='O'
-        self.write_msg()
-        print(self.new_msg)
-    def add_p(self):
-        self.new_msg+='p'
-        self.write_msg()
-        print(self.new_msg)
-    def add_P(self):
-        self.new_msg+='P'
-        self.write_msg()
-        print(self.new_msg)
-    def add_q(self):
-        self.new_msg+='q'
-        self.write_msg()
-        print(self.new_msg)
-    def add_Q(self):
-        self.new_msg+='Q'
-        self.write_msg()
-        print(self.new_msg)
-    def add_r(self):
-        self.new_msg+='r'
-        self.write_msg()
-        print(self.new_msg)
-    def add_R(self):
-        self.new_msg+='R'
-        self.write_msg()
-        print(self.new_msg)
-    def add_s(self):
-        self.new_msg+='s'
-        self.write_msg()
-        print(self.new_msg)
-    def add_S(self):
-        self.new_msg+='S'
-        self.write_msg()
-        print(self.new_msg)
-    def add_t(self):
-        self.new_msg+='t'
-        self.write_msg()
-        print(self.new_msg)
-    def add_T(self):
-        self.new_msg+='T'
-        self.write_msg()
-        print(self.new_msg)
-    def add_u(self):
-        self.new_msg+='u'
-        self.write_msg()
-        print(self.new_msg)
-    def add_U(self):
-        self.new_msg+='U'
-        self.write_msg()
-        print(self.new_msg)
-    def add_v(self):
-        self.new_msg+='v'
-        self.write_msg()
-        print(self.new_msg)
-    def add_V(self):
-        self.new_msg+='V'
-        self.write_msg()
-        print(self.new_msg)
-    def add_w(self):
-        self.new_msg+='w'
-        self.write_msg()
-        print(self.new_msg)
-    def add_W(self):
-        self.new_msg+='W'
-        self.write_msg()
-        print(self.new_msg)
-    def add_x(self):
-        self.new_msg+='x'
-        self.write_msg()
-        print(self.new_msg)
-    def add_X(self):
-        self.new_msg+='X'
-        self.write_msg()
-        print(self.new_msg)
-    def add_y(self):
-        self.new_msg+='y'
-        self.write_msg()
-        print(self.new_msg)
-    def add_Y(self):
-        self.new_msg+='Y'
-        self.write_msg()
-        print(self.new_msg)
-    def add_z(self):
-        self.new_msg+='z'
-        self.write_msg()
-        print(self.new_msg)
-    def add_Z(self):
-        self.new_msg+='Z'
-        self.write_msg()
-        print(self.new_msg)
-    def backspace(self):
-        self.new_msg=self.new_msg[0:-1] #Remove last character
-        self.write_msg()
-        print(self.new_msg)
-    def add_dollar(self):
-        self.new_msg+='$'
-        self.write_msg()
-        print(self.new_msg)
-    def add_dblquote(self):
-        self.new_msg+='"'
-        self.write_msg()
-        print(self.new_msg)
-    def add_quoteright(self):
-        self.new_msg+="'"
-        self.write_msg()
-        print(self.new_msg)
-    def add_quoteleft(self):
-        self.new_msg+="`"
-        self.write_msg()
-        print(self.new_msg)
-    def add_parenleft(self):
-        self.new_msg+="("
-        self.write_msg()
-        print(self.new_msg)
-    def add_parenright(self):
-        self.new_msg+=")"
-        self.write_msg()
-        print(self.new_msg)
-    def add_minus(self):
-        self.new_msg+="-"
-        self.write_msg()
-        print(self.new_msg)
-    def add_slash(self):
-        self.new_msg+="/"
-        self.write_msg()
-        print(self.new_msg)
-    def add_plus(self):
-        self.new_msg+="+"
-        self.write_msg()
-        print(self.new_msg)
-    def add_ampersand(self):
-        self.new_msg+="&"
-        self.write_msg()
-        print(self.new_msg)
-    def add_pound(self):
-        self.new_msg+="#"
-        self.write_msg()
-        print(self.new_msg)
-    def add_asterisk(self):
-        self.new_msg+="*"
-        self.write_msg()
-        print(self.new_msg)
-    def add_percent(self):
-        self.new_msg+="%"
-        self.write_msg()
-        print(self.new_msg)
-    def add_comma(self):
-        self.new_msg+=','
-        self.write_msg()
-        print(self.new_msg)
-    def add_period(self):
-        self.new_msg+='.'
-        self.write_msg()
-        print(self.new_msg)
-    def add_exclaim(self):
-        self.new_msg+='!'
-        self.write_msg()
-        print(self.new_msg)
-    def add_colon(self):
-        self.new_msg+=':'
-        self.write_msg()
-        print(self.new_msg)
-    def add_at(self):
-        self.new_msg+='@'
-        self.write_msg()
-        print(self.new_msg)
-    def add_question(self):
-        self.new_msg+='?'
-        self.write_msg()
-        print(self.new_msg)
-    def add_equal(self):
-        self.new_msg+='='
-        self.write_msg()
-        print(self.new_msg)
-    def add_less(self):
-        self.new_msg+='<'
-        self.write_msg()
-        print(self.new_msg)
-    def add_greater(self):
-        self.new_msg+='>'
-        self.write_msg()
-        print(self.new_msg)
-    def add_underscore(self):
-        self.new_msg+='_'
-        self.write_msg()
-        print(self.new_msg)
-    def add_backslash(self):
-        self.new_msg+='\\'
-        self.write_msg()
-        print(self.new_msg)
-    def add_brackright(self):
-        self.new_msg+=']'
-        self.write_msg()
-        print(self.new_msg)
-    def add_brackleft(self):
-        self.new_msg+='['
-        self.write_msg()
-        print(self.new_msg)
+    def key_pressed(self,event):
+        '''
+        Add the character for a key in _KEYMAP to the message.
 
-    def add_0(self):
-        self.new_msg+='0'
-        self.write_msg()
-        print(self.new_msg)
-    def add_1(self):
-        self.new_msg+='1'
-        self.write_msg()
-        print(self.new_msg)
-    def add_2(self):
-        self.new_msg+='2'
-        self.write_msg()
-        print(self.new_msg)
-    def add_3(self):
-        self.new_msg+='3'
-        self.write_msg()
-        print(self.new_msg)
-    def add_4(self):
-        self.new_msg+='4'
-        self.write_msg()
-        print(self.new_msg)
-    def add_5(self):
-        self.new_msg+='5'
-        self.write_msg()
-        print(self.new_msg)
-    def add_6(self):
-        self.new_msg+='6'
-        self.write_msg()
-        print(self.new_msg)
-    def add_7(self):
-        self.new_msg+='7'
-        self.write_msg()
-        print(self.new_msg)
-    def add_8(self):
-        self.new_msg+='8'
-        self.write_msg()
-        print(self.new_msg)
-    def add_9(self):
-        self.new_msg+='9'
+        :param event: Tk key event.
+        '''
+        c=TextInput._KEYMAP.get(event.keysym)
+        if c is not None :
+            self.add_char(c)
+
+    def request_redraw(self):
+        '''
+        Ask for write_msg to be called once the event loop is idle, so
+        several keystrokes arriving in one frame are drawn together.
+        '''
+        if not self.redraw_pending :
+            self.redraw_pending=True
+            self.renderer.after_idle(self.redraw)
+
+    def redraw(self):
+        self.redraw_pending=False
         self.write_msg()
-        print(self.new_msg)
+        if self.debug :
+            print(self.new_msg)
+
+    #Methods adding (or subtracting, in case of backspace)
+    #letters from message.
+    def add_char(self,c):
+        '''
+        :param c: string, character typed.
+        '''
+        if self.max_msg_length is not None and len(self._buffer) >= self.max_msg_length :
+            return
+        self._buffer.append(c)
+        self._text=None
+        self.layout.append(c)
+        self.request_redraw()
+
+    def insert_text(self,text):
+        '''
+        Add a whole string to the end of the message in one step, with
+        one redraw - for pasting, tests and bots.  Line breaks and tabs
+        become spaces, and text past max_msg_length is dropped.
+
+        :param text: string to add.
+        :return: number of letters added.
+        '''
+        text=text.replace('\r\n',' ').translate(TextInput._PASTE_TRANSLATION)
+        if self.max_msg_length is not None :
+            text=text[:max(0,self.max_msg_length-len(self._buffer))]
+        if len(text) != 0 :
+            self._buffer.extend(text)
+            self._text=None
+            self.layout.append(text)
+            self.request_redraw()
+        return len(text)
+
+    def paste(self,event=None):
+        '''
+        Insert the clipboard contents.
+
+        :param event: Tk event that triggered the paste (unused).
+        '''
+        self.insert_text(self.renderer.clipboard())
+
+    def backspace(self):
+        if len(self._buffer) != 0 :
+            self._buffer.pop() #Remove last character
+            self._text=None
+            self.layout.backspace()
+        self.request_redraw()